@@ -1,19 +1,32 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
 import plotly.graph_objects as go
 import plotly.express as px
 
-from pipeline.extract_text import extract_text
+from pipeline.cache import ExtractCache, hash_file
 from pipeline.parse_ttz import parse_ttz_requirements
-from pipeline.compare import compare_requirements
+from pipeline.profiling import profiling, stage
+from pipeline.compare import iter_compare_requirements, pipeline_version
+from pipeline.match_kd import KDIndex
+from pipeline.ocr import DEFAULT_ENGINE as OCR_ENGINE
 from database import HistoryDatabase
 
-# Инициализация базы данных
+# Инициализация базы данных: один экземпляр и один пул соединений на процесс,
+# каждый rerun берёт соединение из пула и возвращает его после запроса
 @st.cache_resource
 def init_db():
     return HistoryDatabase()
 
+# Общий для всех сессий кэш извлечённого текста
+@st.cache_resource
+def init_extract_cache():
+    return ExtractCache()
+
 # Настройка страницы
 st.set_page_config(
     page_title="Сравнить ТТЗ и КД",
@@ -120,8 +133,82 @@ st.markdown(
 
 # ========== ОПРЕДЕЛЕНИЕ ФУНКЦИЙ ==========
 
-def display_results(df, comparison_id):
-    """Отображает результаты сравнения"""
+def page_progress(label):
+    """Прогресс-бар для постраничного извлечения PDF (обновляется примерно на каждый 1%)"""
+    bar = None
+
+    def on_page(page_no, page_count):
+        nonlocal bar
+        if bar is None:
+            bar = st.progress(0.0, text=label)
+        if page_no == page_count or page_no % max(1, page_count // 100) == 0:
+            bar.progress(page_no / page_count, text=f"{label}: страница {page_no} из {page_count}")
+
+    return on_page
+
+def spool_upload(uploaded_file):
+    """
+    Копирует загруженный файл кусками во временный файл и возвращает путь к нему:
+    хэш и извлечение текста читают файл с диска, без копий содержимого в памяти.
+    Удаляет файл вызывающий.
+    """
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(uploaded_file.name)[1].lower())
+    with os.fdopen(fd, "wb") as f:
+        uploaded_file.seek(0)
+        shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
+    return path
+
+def compare_with_progress(reqs, kd_index, comparison_id, kd_doc=None, flush_every=100, scale_units=False,
+                          chunk_size=16):
+    """
+    Сопоставляет требования с КД, показывая живой прогресс (счётчики статусов и ETA),
+    и по пачкам дописывает строки в БД. Возвращает счётчики статусов.
+    kd_doc — id сохранённого kd_index.kd_text: строки хранят только отрезки фрагментов.
+    scale_units — сравнивать значения внутри семейств единиц (мм/см/м, мА/А, ...).
+    chunk_size — пачка BM25: меньше, чем по умолчанию, чтобы прогресс не шёл рывками.
+    """
+    total = len(reqs)
+    bar = st.progress(0.0, text="🤝 Сопоставляю с КД...")
+    counts = {"OK": 0, "PARTIAL": 0, "FOUND": 0, "NOT_FOUND": 0}
+    batch = []
+    step = max(1, total // 200)
+    t0 = time.perf_counter()
+
+    rows = iter_compare_requirements(reqs, kd_index.kd_text, kd_index=kd_index, kd_doc=kd_doc,
+                                     scale_units=scale_units, chunk_size=chunk_size)
+    for i, row in enumerate(rows, start=1):
+        batch.append(row)
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+
+        if len(batch) >= flush_every:
+            with stage("db_write", items=len(batch)):
+                st.session_state.db.append_rows(comparison_id, batch)
+            batch = []
+
+        if i % step == 0 or i == total:
+            elapsed = time.perf_counter() - t0
+            eta = elapsed / i * (total - i)
+            bar.progress(
+                i / total,
+                text=(f"🤝 {i}/{total} · ✅ {counts['OK']} · ⚠️ {counts['PARTIAL']} · "
+                      f"🔎 {counts['FOUND']} · ❌ {counts['NOT_FOUND']} · осталось ~{eta:.0f} с")
+            )
+
+    with stage("db_write", items=len(batch)):
+        st.session_state.db.append_rows(comparison_id, batch)
+    return counts
+
+ROWS_PER_PAGE = 50
+HISTORY_PAGE_SIZE = 50
+SEARCH_LIMIT = 50
+
+def display_results(comparison_id):
+    """Отображает результаты сравнения (строки подгружаются из БД постранично)"""
+
+    details = st.session_state.db.get_comparison_details(comparison_id)
+    if not details:
+        st.error("Сравнение не найдено")
+        return
 
     st.divider()
     st.subheader(f"📊 Результаты сравнения (ID: {comparison_id})")
@@ -129,11 +216,11 @@ def display_results(df, comparison_id):
     # Метрики
     col1, col2, col3, col4, col5 = st.columns(5)
 
-    total = len(df)
-    ok = int((df["status"] == "OK").sum())
-    partial = int((df["status"] == "PARTIAL").sum())
-    found = int((df["status"].isin(["OK","PARTIAL","FOUND"])).sum())
-    not_found = int((df["status"] == "NOT_FOUND").sum())
+    total = details["total"]
+    ok = details["ok"]
+    partial = details["partial"]
+    found = details["found"]
+    not_found = details["not_found"]
 
     with col1:
         st.metric("Всего", total)
@@ -146,13 +233,53 @@ def display_results(df, comparison_id):
     with col5:
         st.metric("❌ NOT_FOUND", not_found)
 
-    # Таблица результатов
+    # Таблица результатов: фильтр по статусу и страница строк
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        status_filter = st.selectbox(
+            "Статус",
+            ["Все", "OK", "PARTIAL", "FOUND", "NOT_FOUND"],
+            key=f"status_filter_{comparison_id}"
+        )
+    status = None if status_filter == "Все" else status_filter
+    n_rows = st.session_state.db.count_comparison_rows(comparison_id, status=status)
+    n_pages = max(1, (n_rows + ROWS_PER_PAGE - 1) // ROWS_PER_PAGE)
+    with col2:
+        page = st.number_input(
+            f"Страница (из {n_pages})", min_value=1, max_value=n_pages, value=1,
+            key=f"rows_page_{comparison_id}_{status_filter}"
+        )
+
+    # Фрагменты КД и различия здесь не нужны — они восстанавливаются только для выбранной строки
+    rows = st.session_state.db.get_comparison_rows(
+        comparison_id, status=status, limit=ROWS_PER_PAGE, offset=(page - 1) * ROWS_PER_PAGE,
+        materialize=False
+    )
+    df = pd.DataFrame(
+        rows,
+        columns=["row_idx", "req_id", "ttz_section", "req_text", "status", "match_type",
+                 "kd_evidence", "numbers_covered", "diff"]
+    )
     st.dataframe(
         df[["req_id","ttz_section","status","match_type","numbers_covered","req_text"]],
         use_container_width=True,
         height=400
     )
 
+    # Профиль выполнения
+    profile = st.session_state.db.get_profile(comparison_id)
+    if profile:
+        with st.expander("⏱ Профиль"):
+            prof_df = pd.DataFrame(profile)
+            st.dataframe(
+                prof_df[["stage", "calls", "items", "seconds", "p50", "p95", "max"]],
+                use_container_width=True
+            )
+            for p in profile:
+                if p["slowest"]:
+                    st.markdown(f"**Самые медленные: {p['stage']}**")
+                    st.dataframe(pd.DataFrame(p["slowest"]), use_container_width=True)
+
     # Комментарии
     st.divider()
     st.subheader("💬 Комментарии")
@@ -186,22 +313,31 @@ def display_results(df, comparison_id):
             st.success("✅ Комментарий добавлен!")
             st.rerun()
 
-    # Доказательства
+    # Доказательства: фрагмент КД и различия — только для выбранного требования текущей страницы
     st.divider()
     st.subheader("🔍 Доказательства из КД")
 
-    for _, row in df.iterrows():
-        with st.expander(f"{row['req_id']} — {row['status']}"):
-            st.markdown("**Требование (ТТЗ):**")
-            st.write(row["req_text"])
-            st.markdown("**Фрагмент из КД:**")
-            if row["kd_evidence"]:
-                st.write(row["kd_evidence"])
-            else:
-                st.write("*Фрагмент не найден*")
-            if row["diff"]:
-                st.markdown("**Различия:**")
-                st.code(row["diff"])
+    if not rows:
+        st.info("Нет строк на этой странице")
+        return
+
+    row_idx = st.selectbox(
+        "Требование",
+        [r["row_idx"] for r in rows],
+        format_func={r["row_idx"]: f"{r['req_id']} — {r['status']}" for r in rows}.get,
+        key=f"evidence_row_{comparison_id}_{status_filter}_{page}"
+    )
+    row = st.session_state.db.get_comparison_row(comparison_id, row_idx)
+    st.markdown("**Требование (ТТЗ):**")
+    st.write(row["req_text"])
+    st.markdown("**Фрагмент из КД:**")
+    if row["kd_evidence"]:
+        st.write(row["kd_evidence"])
+    else:
+        st.write("*Фрагмент не найден*")
+    if row["diff"]:
+        st.markdown("**Различия:**")
+        st.code(row["diff"])
 
 def display_comparison_details(comparison_id):
     """Отображает детали конкретного сравнения"""
@@ -218,10 +354,7 @@ def display_comparison_details(comparison_id):
     - **Файл КД:** {comparison['kd_filename']}
     """)
 
-    # Преобразуем JSON обратно в DataFrame
-    df = pd.DataFrame(comparison['results_json'])
-
-    display_results(df, comparison_id)
+    display_results(comparison_id)
 
 def show_main_page():
     """Отображает основную страницу с загрузкой файлов"""
@@ -249,6 +382,12 @@ def show_main_page():
             key="kd"
         )
 
+    scale_units = st.checkbox(
+        "📏 Пересчитывать единицы (мм/см/м, мА/А, г/кг, бит/с)",
+        value=False,
+        help="Сравнивать значения в разных единицах одного семейства; по умолчанию — только в той же единице"
+    )
+
     st.divider()
 
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -261,45 +400,91 @@ def show_main_page():
         )
 
     if run and ttz_file and kd_file:
+        spooled = []
+        # незавершённое сравнение: при ошибке удаляется вместе с записанными строками
+        running_id = None
         with st.status("🔄 Обработка файлов...", expanded=True) as status:
             try:
-                # Извлечение текста из ТТЗ
-                st.write("📑 Извлекаю текст из ТТЗ...")
-                ttz_text, ttz_meta = extract_text(ttz_file.getvalue(), ttz_file.name)
-                st.write(f"✅ Текст извлечен: {ttz_meta['text_len']} символов")
-
-                # Извлечение текста из КД
-                st.write("📑 Извлекаю текст из КД...")
-                kd_text, kd_meta = extract_text(kd_file.getvalue(), kd_file.name)
-                st.write(f"✅ Текст извлечен: {kd_meta['text_len']} символов")
-
-                # Парсинг требований
-                st.write("🔍 Анализирую требования ТТЗ...")
-                reqs = parse_ttz_requirements(ttz_text)
-                st.write(f"✅ Найдено требований: {len(reqs)}")
-
-                # Сравнение
-                st.write("🤝 Сопоставляю с КД...")
-                rows = compare_requirements(reqs, kd_text)
-
-                # Создаем DataFrame
-                df = pd.DataFrame(rows)
-
-                # Сохраняем в историю
-                comparison_id = st.session_state.db.save_comparison(
-                    ttz_filename=ttz_file.name,
-                    kd_filename=kd_file.name,
-                    df_results=df,
-                    user_name=st.session_state.current_user
-                )
+                # Загрузки — во временные файлы: дальше они открываются по пути
+                ttz_path = spool_upload(ttz_file)
+                spooled.append(ttz_path)
+                kd_path = spool_upload(kd_file)
+                spooled.append(kd_path)
+                ttz_hash = hash_file(ttz_path)
+                kd_hash = hash_file(kd_path)
+
+                # Та же пара файлов уже сравнивалась этой версией пайплайна (и с теми же настройками)?
+                version = pipeline_version(scale_units)
+                cached_id = st.session_state.db.find_comparison(ttz_hash, kd_hash, version)
+
+                if cached_id:
+                    st.write(f"♻️ Эта пара файлов уже сравнивалась (ID: {cached_id}), использую готовый результат")
+                    comparison_id = st.session_state.db.save_rerun(
+                        source_id=cached_id,
+                        ttz_filename=ttz_file.name,
+                        kd_filename=kd_file.name,
+                        user_name=st.session_state.current_user
+                    )
+                else:
+                    # Профиль по стадиям сохраняется вместе со сравнением
+                    with profiling() as prof:
+                        # Извлечение текста из ТТЗ
+                        st.write("📑 Извлекаю текст из ТТЗ...")
+                        with stage("extract_ttz"):
+                            ttz_text, ttz_meta = init_extract_cache().extract(
+                                ttz_path, ttz_file.name, file_hash=ttz_hash,
+                                on_page=page_progress("ТТЗ"), ocr=OCR_ENGINE
+                            )
+                        st.write(f"✅ Текст извлечен: {ttz_meta['text_len']} символов"
+                                 + (" (из кэша)" if ttz_meta.get("cache") == "hit" else ""))
+                        if ttz_meta.get("ocr_pages"):
+                            st.write(f"🔎 OCR страниц: {len(ttz_meta['ocr_pages'])}"
+                                     + (f", не успели: {len(ttz_meta['ocr_skipped'])}" if ttz_meta.get("ocr_skipped") else ""))
+
+                        # Извлечение текста из КД
+                        st.write("📑 Извлекаю текст из КД...")
+                        with stage("extract_kd"):
+                            kd_text, kd_meta = init_extract_cache().extract(
+                                kd_path, kd_file.name, file_hash=kd_hash,
+                                on_page=page_progress("КД"), ocr=OCR_ENGINE
+                            )
+                        st.write(f"✅ Текст извлечен: {kd_meta['text_len']} символов"
+                                 + (" (из кэша)" if kd_meta.get("cache") == "hit" else ""))
+                        if kd_meta.get("ocr_pages"):
+                            st.write(f"🔎 OCR страниц: {len(kd_meta['ocr_pages'])}"
+                                     + (f", не успели: {len(kd_meta['ocr_skipped'])}" if kd_meta.get("ocr_skipped") else ""))
+
+                        # Парсинг требований
+                        st.write("🔍 Анализирую требования ТТЗ...")
+                        reqs = parse_ttz_requirements(ttz_text)
+                        st.write(f"✅ Найдено требований: {len(reqs)}")
+
+                        # Сравнение: строки пишутся в историю по мере готовности
+                        st.write("🤝 Сопоставляю с КД...")
+                        comparison_id = running_id = st.session_state.db.start_comparison(
+                            ttz_filename=ttz_file.name,
+                            kd_filename=kd_file.name,
+                            user_name=st.session_state.current_user,
+                            ttz_hash=ttz_hash,
+                            kd_hash=kd_hash,
+                            pipeline_version=version
+                        )
+                        kd_index = KDIndex(kd_text)
+                        with stage("db_write"):
+                            kd_doc = st.session_state.db.save_document(kd_index.kd_text)
+                        compare_with_progress(reqs, kd_index, comparison_id, kd_doc=kd_doc, scale_units=scale_units)
+                        with stage("db_write"):
+                            st.session_state.db.finish_comparison(comparison_id)
+                        running_id = None
+
+                    st.session_state.db.save_profile(comparison_id, prof.summary())
 
                 status.update(
                     label=f"✅ Готово! ID сравнения: {comparison_id}",
                     state="complete"
                 )
 
-                # Сохраняем результаты в сессию для отображения
-                st.session_state.last_results = df
+                # Сохраняем ID в сессию: строки результата отображаются прямо из БД
                 st.session_state.last_comparison_id = comparison_id
                 st.session_state.page = "history"
                 st.rerun()
@@ -307,17 +492,18 @@ def show_main_page():
             except Exception as e:
                 status.update(label="❌ Ошибка при обработке", state="error")
                 st.error(f"Произошла ошибка: {str(e)}")
+                if running_id is not None:
+                    st.session_state.db.discard_comparison(running_id)
+            finally:
+                for path in spooled:
+                    os.remove(path)
 
     # Отображение результатов, если они есть
     if (
             st.session_state.page == "main"
-            and 'last_results' in st.session_state
             and 'last_comparison_id' in st.session_state
     ):
-        display_results(
-            st.session_state.last_results,
-            st.session_state.last_comparison_id
-        )
+        display_results(st.session_state.last_comparison_id)
 
 
 
@@ -326,41 +512,76 @@ def show_history_page():
 
     st.header("📜 История сравнений")
 
-    # Получаем все сравнения из БД
-    comparisons = st.session_state.db.get_all_comparisons()
-
-    if not comparisons:
+    if st.session_state.db.count_comparisons() == 0:
         st.info("📭 История пока пуста. Выполните сравнение на главной странице.")
         return
 
-    # Создаем DataFrame для отображения
-    history_df = pd.DataFrame(comparisons)
-    history_df['timestamp'] = pd.to_datetime(history_df['timestamp'])
-    history_df['date'] = history_df['timestamp'].dt.strftime('%d.%m.%Y %H:%M')
+    # Полнотекстовый поиск по требованиям и доказательствам всех сравнений
+    if st.session_state.db.has_fts:
+        query = st.text_input("🔎 Поиск по требованиям и доказательствам КД", key="history_search")
+        if query.strip():
+            t0 = time.perf_counter()
+            hits = st.session_state.db.search(query, limit=SEARCH_LIMIT)
+            st.caption(f"Найдено: {len(hits)}{'+' if len(hits) == SEARCH_LIMIT else ''} "
+                       f"за {(time.perf_counter() - t0) * 1000:.0f} мс")
+            for h in hits:
+                st.markdown(
+                    f"**ID {h['comparison_id']}** · {h['timestamp'][:16]} · "
+                    f"{h['ttz_filename']} ↔ {h['kd_filename']} · {h['req_id']} — {h['status']}"
+                )
+                st.markdown(f"ТТЗ: {h['req_snippet']}")
+                if h['evidence_snippet']:
+                    st.markdown(f"КД: {h['evidence_snippet']}")
+            st.divider()
+
+    # Фильтры
+    with st.expander("🔎 Фильтры"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            dates = st.date_input("Период", value=(), key="history_dates")
+        with col2:
+            filename = st.text_input("Файл ТТЗ (начало имени)", key="history_filename")
+        with col3:
+            user_filter = st.text_input("Пользователь", key="history_user")
+
+    filters = {
+        "date_from": dates[0].isoformat() if len(dates) > 0 else None,
+        "date_to": (dates[-1] + timedelta(days=1)).isoformat() if len(dates) > 0 else None,
+        "filename": filename.strip() or None,
+        "user_name": user_filter.strip() or None,
+    }
+
+    # При смене фильтров пагинация начинается заново
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+
+    # Статистика по всем сравнениям (агрегатами в БД)
+    stats = st.session_state.db.get_history_stats(**filters)
+    if stats['count'] == 0:
+        st.info("Нет сравнений, подходящих под фильтры")
+        return
 
-    # Статистика по всем сравнениям
     st.subheader("📊 Общая статистика")
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        st.metric("Всего сравнений", len(comparisons))
+        st.metric("Всего сравнений", stats['count'])
     with col2:
-        total_reqs = sum(c['total'] for c in comparisons)
-        st.metric("Всего требований", total_reqs)
+        st.metric("Всего требований", stats['total'])
     with col3:
-        avg_found = sum(c['found'] for c in comparisons) / len(comparisons)
-        st.metric("Среднее найденных", f"{avg_found:.1f}")
+        st.metric("Среднее найденных", f"{stats['avg_found']:.1f}")
     with col4:
-        success_rate = (sum(c['found'] for c in comparisons) / total_reqs * 100) if total_reqs > 0 else 0
+        success_rate = (stats['found'] / stats['total'] * 100) if stats['total'] > 0 else 0
         st.metric("Общий % покрытия", f"{success_rate:.1f}%")
 
     st.divider()
 
     # График активности
-    if len(comparisons) > 1:
+    if len(stats['by_day']) > 1:
         fig = px.line(
-            x=[c['timestamp'] for c in comparisons],
-            y=[c['found'] for c in comparisons],
+            x=[d['date'] for d in stats['by_day']],
+            y=[d['found'] for d in stats['by_day']],
             title="Динамика найденных требований",
             labels={'x': 'Дата', 'y': 'Найдено требований'}
         )
@@ -371,10 +592,29 @@ def show_history_page():
     # Выбор сравнения для просмотра
     st.subheader("🔍 Детальный просмотр")
 
+    # Одна страница истории: keyset-курсор — (timestamp, id) последней записи предыдущей страницы
+    cursors = st.session_state.history_cursors
+    page = st.session_state.db.list_comparisons(limit=HISTORY_PAGE_SIZE + 1, after=cursors[-1], **filters)
+    has_next = len(page) > HISTORY_PAGE_SIZE
+    page = page[:HISTORY_PAGE_SIZE]
+
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("← Новее", disabled=len(cursors) == 1, use_container_width=True):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Страница {len(cursors)} из {(stats['count'] + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE}")
+    with col3:
+        if st.button("Старее →", disabled=not has_next, use_container_width=True):
+            cursors.append((page[-1]['timestamp'], page[-1]['id']))
+            st.rerun()
+
     # Создаем список для выбора
     options = {
-        f"{row['date']} - {row['ttz_filename']} ({row['found']}/{row['total']})": row['id']
-        for _, row in history_df.iterrows()
+        f"{pd.to_datetime(c['timestamp']).strftime('%d.%m.%Y %H:%M')} - {c['ttz_filename']} "
+        f"({c['found']}/{c['total']})": c['id']
+        for c in page
     }
 
     selected = st.selectbox(
@@ -407,7 +647,7 @@ with st.sidebar:
 
     # количество записей истории (достаем быстро из БД)
     try:
-        history_count = len(st.session_state.db.get_all_comparisons())
+        history_count = st.session_state.db.count_comparisons()
     except Exception:
         history_count = 0
 
@@ -0,0 +1,247 @@
+# batch_compare.py
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import product
+from typing import Any, Dict, List, Set, Tuple
+
+from pipeline.cache import ExtractCache, hash_file
+from pipeline.compare import iter_compare_requirements, pipeline_version
+from pipeline.extract_text import extract_text
+from pipeline.match_kd import KDIndex
+from pipeline.ocr import DEFAULT_ENGINE as OCR_ENGINE
+from pipeline.parse_ttz import parse_ttz_requirements
+
+SUPPORTED_EXT = (".pdf", ".docx", ".txt")
+
+def load_manifest(path: str) -> List[Tuple[str, str]]:
+    """
+    CSV со столбцами ttz,kd или JSON: [{"ttz": ..., "kd": ...}, ...] / [[ttz, kd], ...].
+    Относительные пути считаются от каталога манифеста.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            items = json.load(f)
+        pairs = [(it["ttz"], it["kd"]) if isinstance(it, dict) else (it[0], it[1]) for it in items]
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            pairs = [(r["ttz"], r["kd"]) for r in csv.DictReader(f)]
+    return [(os.path.join(base, t), os.path.join(base, k)) for t, k in pairs]
+
+def pairs_from_dirs(ttz_dir: str, kd_dir: str) -> List[Tuple[str, str]]:
+    """Каждый ТТЗ из ttz_dir против каждого КД из kd_dir"""
+    def files(d):
+        return sorted(
+            os.path.join(d, n) for n in os.listdir(d)
+            if n.lower().endswith(SUPPORTED_EXT) and os.path.isfile(os.path.join(d, n))
+        )
+    return list(product(files(ttz_dir), files(kd_dir)))
+
+def pair_key(ttz_path: str, kd_path: str, version: str) -> str:
+    return f"{os.path.abspath(ttz_path)}|{os.path.abspath(kd_path)}|{version}"
+
+def load_done(out_path: str) -> Set[str]:
+    """
+    Ключи пар, уже успешно записанных в JSONL, с версией, которой они посчитаны
+    (битая последняя строка после падения игнорируется)
+    """
+    done: Set[str] = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" not in rec:
+                done.add(pair_key(rec["ttz"], rec["kd"], rec.get("pipeline_version", "")))
+    return done
+
+def summarize(rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    statuses = [r["status"] for r in rows]
+    return {
+        "total": len(rows),
+        "found": sum(s in ("OK", "PARTIAL", "FOUND") for s in statuses),
+        "ok": statuses.count("OK"),
+        "partial": statuses.count("PARTIAL"),
+        "not_found": statuses.count("NOT_FOUND"),
+    }
+
+def _extract(path: str, cache) -> Tuple[str, str]:
+    # файл не читается в память целиком: хэш — потоково, извлечение — по пути
+    file_hash = hash_file(path)
+    name = os.path.basename(path)
+    # внутри воркера пула PDF разбираем в один поток — параллелизм уже на уровне пар;
+    # OCR сканированных страниц — если задан OCR_ENGINE
+    if cache is not None:
+        text, _ = cache.extract(path, name, file_hash=file_hash, workers=1, ocr=OCR_ENGINE)
+    else:
+        text, _ = extract_text(path, name, workers=1, ocr=OCR_ENGINE)
+    return text, file_hash
+
+# Состояние процесса-воркера: кэш извлечения и последний КД (путь, текст, хэш, индекс)
+_worker_cache = None
+_worker_kd = None
+
+def _load_kd(kd_path: str, use_cache: bool) -> Tuple[str, str, KDIndex]:
+    """КД извлекается и индексируется один раз на процесс, пока ему идут пары с этим КД"""
+    global _worker_cache, _worker_kd
+    if use_cache and _worker_cache is None:
+        _worker_cache = ExtractCache()
+    if _worker_kd is None or _worker_kd[0] != kd_path:
+        _worker_kd = None  # прежний индекс освобождается до построения нового
+        kd_text, kd_hash = _extract(kd_path, _worker_cache if use_cache else None)
+        _worker_kd = (kd_path, kd_text, kd_hash, KDIndex(kd_text))
+    return _worker_kd[1:]
+
+def run_pair(ttz_path: str, kd_path: str, use_cache: bool, scale_units: bool = False) -> Dict[str, Any]:
+    """Одна пара ТТЗ–КД (запись для JSONL; при ошибке — с ключом error)"""
+    try:
+        kd_text, kd_hash, kd_index = _load_kd(kd_path, use_cache)
+    except Exception as e:
+        return {"ttz": ttz_path, "kd": kd_path, "error": f"КД: {e}"}
+
+    try:
+        ttz_text, ttz_hash = _extract(ttz_path, _worker_cache if use_cache else None)
+        reqs = parse_ttz_requirements(ttz_text)
+        rows = list(iter_compare_requirements(reqs, kd_text, kd_index=kd_index, scale_units=scale_units))
+        return {
+            "ttz": ttz_path,
+            "kd": kd_path,
+            "ttz_hash": ttz_hash,
+            "kd_hash": kd_hash,
+            "pipeline_version": pipeline_version(scale_units),
+            "timestamp": datetime.now().isoformat(),
+            "stats": summarize(rows),
+            "rows": rows,
+        }
+    except Exception as e:
+        return {"ttz": ttz_path, "kd": kd_path, "error": str(e)}
+
+def save_to_db(db, rec: Dict[str, Any], user_name: str) -> int:
+    """Записывает результат пары в историю; при ошибке незавершённое сравнение удаляется"""
+    cid = db.start_comparison(
+        ttz_filename=os.path.basename(rec["ttz"]),
+        kd_filename=os.path.basename(rec["kd"]),
+        user_name=user_name,
+        ttz_hash=rec["ttz_hash"],
+        kd_hash=rec["kd_hash"],
+        pipeline_version=rec["pipeline_version"],
+    )
+    try:
+        db.append_rows(cid, rec["rows"])
+        db.finish_comparison(cid)
+    except Exception:
+        db.discard_comparison(cid)
+        raise
+    return cid
+
+def run_batch(pairs: List[Tuple[str, str]], out_path: str, workers: int,
+              save_db: bool = False, db_path: str = "comparison_history.db",
+              user_name: str = "batch", use_cache: bool = True, scale_units: bool = False):
+    done = load_done(out_path)
+    version = pipeline_version(scale_units)
+    todo = [(t, k) for t, k in pairs if pair_key(t, k, version) not in done]
+    print(f"Пар всего: {len(pairs)}, уже готово: {len(pairs) - len(todo)}, к выполнению: {len(todo)}")
+    if not todo:
+        return
+
+    # пары одного КД — подряд: воркер, получивший следующую пару того же КД, не строит индекс заново
+    groups: "OrderedDict[str, List[str]]" = OrderedDict()
+    for t, k in todo:
+        groups.setdefault(k, []).append(t)
+    ordered = [(t, k) for k, ts in groups.items() for t in ts]
+
+    db = None
+    if save_db:
+        from database import HistoryDatabase
+        db = HistoryDatabase(db_path)
+
+    # дописываем; если прошлый запуск оборвался посреди строки — начинаем с новой
+    if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+        with open(out_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    else:
+        needs_newline = False
+
+    finished = 0
+    failed = 0
+    with open(out_path, "a", encoding="utf-8") as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        if needs_newline:
+            out.write("\n")
+        # задача — одна пара: запись пишется, как только пара готова
+        futures = {pool.submit(run_pair, t, k, use_cache, scale_units): (t, k) for t, k in ordered}
+        for fut in as_completed(futures):
+            try:
+                rec = fut.result()
+            except Exception as e:
+                # упал сам воркер (например, BrokenProcessPool): пара не считается готовой
+                # и повторится при следующем запуске
+                t, k = futures[fut]
+                rec = {"ttz": t, "kd": k, "error": f"воркер: {e!r}"}
+            # сначала история, потом JSONL: пара, записанная в JSONL, считается готовой (load_done)
+            if db is not None and "error" not in rec:
+                try:
+                    save_to_db(db, rec, user_name)
+                except Exception as e:
+                    rec = {"ttz": rec["ttz"], "kd": rec["kd"], "error": f"БД: {e}"}
+
+            finished += 1
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+
+            if "error" in rec:
+                failed += 1
+                print(f"[{finished}/{len(todo)}] ❌ {rec['ttz']} ↔ {rec['kd']}: {rec['error']}")
+                continue
+
+            s = rec["stats"]
+            print(f"[{finished}/{len(todo)}] {rec['ttz']} ↔ {rec['kd']}: найдено {s['found']}/{s['total']}")
+
+    if db is not None:
+        db.close()
+    print(f"Готово: {finished - failed} успешно, {failed} с ошибкой. Результаты: {out_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пакетное сравнение ТТЗ и КД без UI")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--manifest", help="CSV (ttz,kd) или JSON со списком пар")
+    src.add_argument("--ttz-dir", help="Каталог с ТТЗ (сравнивается с каждым КД из --kd-dir)")
+    parser.add_argument("--kd-dir", help="Каталог с КД")
+    parser.add_argument("--out", default="batch_results.jsonl", help="Файл результатов JSONL (дописывается)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Число процессов")
+    parser.add_argument("--db", action="store_true", help="Сохранять результаты в историю (HistoryDatabase)")
+    parser.add_argument("--db-path", default="comparison_history.db", help="Путь к БД истории")
+    parser.add_argument("--user", default="batch", help="Имя пользователя для записей в истории")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш извлечённого текста")
+    parser.add_argument("--scale-units", action="store_true",
+                        help="Пересчитывать единицы внутри семейства (мм/см/м, мА/А, г/кг, бит/с)")
+
+    args = parser.parse_args()
+
+    if args.ttz_dir and not args.kd_dir:
+        parser.error("--ttz-dir требует --kd-dir")
+
+    pairs = load_manifest(args.manifest) if args.manifest else pairs_from_dirs(args.ttz_dir, args.kd_dir)
+    if not pairs:
+        print("Нет пар для сравнения")
+        sys.exit(0)
+
+    run_batch(
+        pairs,
+        out_path=args.out,
+        workers=max(1, args.workers),
+        save_db=args.db,
+        db_path=args.db_path,
+        user_name=args.user,
+        use_cache=not args.no_cache,
+        scale_units=args.scale_units,
+    )
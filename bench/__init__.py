@@ -0,0 +1,6 @@
+"""
+Синтетические бенчмарки пайплайна.
+
+    python -m bench.run --ttz-sizes 100,1000 --kd-sizes 200,2000 --out bench.jsonl
+    python -m bench.run ... --baseline bench_old.jsonl
+"""
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from itertools import product
+from typing import Any, Callable, Dict, List, Tuple
+
+from bench.synth import make_kd, make_ttz, to_docx_bytes, to_pdf_bytes
+from pipeline.compare import PIPELINE_VERSION, eval_constraints, eval_constraints_batch
+from pipeline.extract_text import extract_text
+from pipeline.match_kd import KDIndex, find_best_block, tokenize
+from pipeline.parse_ttz import RequirementTable, parse_ttz_requirements
+
+def _timed(fn: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    """Минимальное время из repeat запусков и результат последнего"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+def run_case(n_reqs: int, n_paras: int, fmt: str, repeat: int, seed: int) -> List[Dict[str, Any]]:
+    ttz_text, nums = make_ttz(n_reqs, seed=seed)
+    kd_text = make_kd(n_paras, nums, seed=seed)
+    if fmt == "pdf":
+        kd_bytes = to_pdf_bytes(kd_text)
+    elif fmt == "docx":
+        kd_bytes = to_docx_bytes(kd_text)
+    else:
+        kd_bytes = kd_text.encode("utf-8")
+
+    out: List[Dict[str, Any]] = []
+
+    def record(stage: str, seconds: float, items: int):
+        out.append({
+            "stage": stage,
+            "seconds": round(seconds, 6),
+            "items": items,
+            "per_item_ms": round(seconds / items * 1000, 4) if items else None,
+        })
+
+    sec, _ = _timed(lambda: extract_text(kd_bytes, f"kd.{fmt}", workers=1), repeat)
+    record("extract_text", sec, 1)
+
+    sec, reqs = _timed(lambda: parse_ttz_requirements(ttz_text), repeat)
+    record("parse_ttz_requirements", sec, len(reqs))
+
+    sec, kd_index = _timed(lambda: KDIndex(kd_text), repeat)
+    record("kd_index", sec, len(kd_index.blocks))
+
+    def match_all():
+        return [
+            find_best_block(kd_text, r.num, r.text, r.nums_units, kd_index=kd_index)
+            for r in reqs
+        ]
+    sec, matches = _timed(match_all, repeat)
+    record("find_best_block", sec, len(reqs))
+
+    matched = [(r, m) for r, m in zip(reqs, matches) if m["evidence"]]
+    sec, _ = _timed(
+        lambda: [eval_constraints(r.constraints, m["evidence"], kd_index=kd_index, span=m["span"])
+                 for r, m in matched],
+        repeat,
+    )
+    record("eval_constraints", sec, len(matched))
+
+    sec, _ = _timed(lambda: eval_constraints_batch(reqs, matches, kd_index=kd_index), repeat)
+    record("eval_constraints_batch", sec, len(matched))
+
+    table = RequirementTable(reqs)
+    sec, _ = _timed(lambda: eval_constraints_batch(table, matches, kd_index=kd_index), repeat)
+    record("eval_constraints_table", sec, len(matched))
+
+    rows = [
+        {
+            "req_id": r.req_id, "ttz_section": r.section, "req_text": r.text,
+            "status": "FOUND" if m["evidence"] else "NOT_FOUND", "match_type": m["match_type"],
+            "kd_evidence": m["evidence"], "numbers_covered": "", "diff": "",
+        }
+        for r, m in zip(reqs, matches)
+    ]
+
+    def save():
+        import pandas as pd
+        from database import HistoryDatabase
+
+        with tempfile.TemporaryDirectory() as d:
+            db = HistoryDatabase(os.path.join(d, "bench.db"))
+            db.save_comparison("ttz.txt", f"kd.{fmt}", pd.DataFrame(rows), user_name="bench")
+    sec, _ = _timed(save, repeat)
+    record("save_comparison", sec, len(rows))
+
+    for rec in out:
+        rec.update({"n_reqs": len(reqs), "kd_paras": n_paras, "kd_chars": len(kd_text), "format": fmt})
+    return out
+
+def _legacy_score(rset, req_nums_units, bset, s: str) -> float:
+    """Скоринг блока до индекса чисел (compare-1): число и единица — подстроки нормализованного текста"""
+    if not bset:
+        return 0.0
+    tok_score = len(rset & bset) / max(1, len(rset))
+    num_score = 0.0
+    for num, unit in req_nums_units:
+        if num and (num in s):
+            num_score += 0.6
+        if unit and (unit in s):
+            num_score += 0.4
+    return tok_score * 3.0 + min(2.0, num_score)
+
+def scoring_diff(n_reqs: int, n_paras: int, seed: int) -> Dict[str, Any]:
+    """
+    Выбор блока текущим скорингом (значение в той же единице по NumberIndex) против прежнего
+    (подстроки в тексте блока) на синтетическом наборе; строки с явной ссылкой не сравниваются.
+    changed — выбран другой блок, status_flips — другой статус (проверка по всему блоку),
+    hit_* — в выбранном блоке действительно есть значение требования в его единице.
+    """
+    ttz_text, nums = make_ttz(n_reqs, seed=seed)
+    kd_text = make_kd(n_paras, nums, seed=seed)
+    reqs = parse_ttz_requirements(ttz_text)
+    kd_index = KDIndex(kd_text)
+    block_by_start = {spans[0][0]: i for i, spans in enumerate(kd_index.block_spans)}
+
+    def status(r, i: int) -> str:
+        if i < 0:
+            return "NOT_FOUND"
+        spans = kd_index.block_spans[i]
+        span = (spans[0][0], spans[-1][1])
+        sat, tot, _ = eval_constraints(r.constraints, kd_index.blocks[i], kd_index=kd_index, span=span)
+        return "FOUND" if tot == 0 else ("OK" if sat == tot else "PARTIAL")
+
+    def hit(r, i: int) -> bool:
+        return i >= 0 and any(float(n) in kd_index.numbers.block_values(i, u) for n, u in r.nums_units)
+
+    res = {"rows": 0, "changed": 0, "status_flips": 0, "hit_old": 0, "hit_new": 0, "found_old": 0, "found_new": 0}
+    flips: Counter = Counter()
+    for r in reqs:
+        new = find_best_block(kd_text, r.num, r.text, r.nums_units, kd_index=kd_index)
+        if new["match_type"] == "explicit_ref":
+            continue
+        new_i = block_by_start[new["span"][0]] if new["span"] else -1
+
+        rset = set(tokenize(r.text))
+        old_i, old_score = -1, 0.0
+        for i in kd_index.candidates(rset):
+            sc = _legacy_score(rset, r.nums_units, kd_index.block_tokens[i], kd_index.block_norm[i])
+            if sc > old_score:
+                old_i, old_score = i, sc
+        if old_score < 0.9:
+            old_i = -1
+
+        res["rows"] += 1
+        res["changed"] += old_i != new_i
+        res["hit_old"] += hit(r, old_i)
+        res["hit_new"] += hit(r, new_i)
+        res["found_old"] += old_i >= 0
+        res["found_new"] += new_i >= 0
+        a, b = status(r, old_i), status(r, new_i)
+        if a != b:
+            res["status_flips"] += 1
+            flips[f"{a}->{b}"] += 1
+    res["flips"] = dict(flips.most_common())
+    res.update({"stage": "scoring_diff", "n_reqs": len(reqs), "kd_paras": n_paras, "kd_chars": len(kd_text)})
+    return res
+
+def load_results(path: str) -> Dict[Tuple, float]:
+    res = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            r = json.loads(line)
+            res[(r["stage"], r["n_reqs"], r["kd_paras"], r["format"])] = r["seconds"]
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетический бенчмарк пайплайна ТТЗ/КД")
+    parser.add_argument("--ttz-sizes", default="100,500,2000", help="Числа требований через запятую")
+    parser.add_argument("--kd-sizes", default="200,1000,5000", help="Числа абзацев КД через запятую")
+    parser.add_argument("--format", choices=["txt", "pdf", "docx"], default="txt", help="Формат КД для extract_text")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов на замер (берётся минимум)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Дописать результаты в JSONL (по умолчанию — stdout)")
+    parser.add_argument("--baseline", help="JSONL прошлого прогона для сравнения")
+    parser.add_argument("--scoring-diff", action="store_true",
+                        help="Вместо замеров сравнить выбор блоков с прежним скорингом по подстрокам")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    started = datetime.now().isoformat()
+    baseline = load_results(args.baseline) if args.baseline else {}
+
+    sink = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    try:
+        for n_reqs, n_paras in product(
+                [int(x) for x in args.ttz_sizes.split(",")],
+                [int(x) for x in args.kd_sizes.split(",")],
+        ):
+            if args.scoring_diff:
+                rec = scoring_diff(n_reqs, n_paras, args.seed)
+                rec.update({"run_id": run_id, "timestamp": started, "pipeline_version": PIPELINE_VERSION})
+                sink.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                sink.flush()
+                print(f"reqs={rec['n_reqs']:<6} paras={rec['kd_paras']:<6} строк={rec['rows']} "
+                      f"другой блок={rec['changed']} другой статус={rec['status_flips']} "
+                      f"значение в блоке: было {rec['hit_old']}, стало {rec['hit_new']} "
+                      f"(найдено {rec['found_old']} -> {rec['found_new']}) {rec['flips']}", file=sys.stderr)
+                continue
+            for rec in run_case(n_reqs, n_paras, args.format, max(1, args.repeat), args.seed):
+                rec.update({"run_id": run_id, "timestamp": started, "pipeline_version": PIPELINE_VERSION})
+                sink.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                sink.flush()
+
+                line = f"{rec['stage']:<24} reqs={rec['n_reqs']:<6} paras={rec['kd_paras']:<6} {rec['seconds']:.4f}s"
+                old = baseline.get((rec["stage"], rec["n_reqs"], rec["kd_paras"], rec["format"]))
+                if old:
+                    line += f"  (было {old:.4f}s, x{old / rec['seconds']:.2f})" if rec["seconds"] else ""
+                print(line, file=sys.stderr)
+    finally:
+        if args.out:
+            sink.close()
+
+if __name__ == "__main__":
+    main()
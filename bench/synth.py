@@ -0,0 +1,108 @@
+import random
+from typing import List, Tuple
+
+WORDS = (
+    "система питание напряжение светильник корпус защита кабель аккумулятор модуль связь "
+    "скорость передача температура эксплуатация масса габариты мощность яркость ток частота "
+    "контроллер интерфейс датчик память процессор антенна излучатель крепление разъём панель"
+).split()
+
+UNITS = ["в", "вт", "кг", "мм", "см", "м", "лм", "а", "ма", "%", "мгц", "гб", "мбит/с"]
+
+def _phrase(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(n))
+
+def _constraint(rnd: random.Random) -> str:
+    unit = rnd.choice(UNITS)
+    v = rnd.randint(1, 500)
+    kind = rnd.random()
+    if kind < 0.3:
+        return f"не менее {v} {unit}"
+    if kind < 0.55:
+        return f"не более {v} {unit}"
+    if kind < 0.8:
+        return f"от {v} {unit} до {v + rnd.randint(1, 100)} {unit}"
+    return f"{v} {unit}"
+
+def make_ttz(n_reqs: int, seed: int = 0, bullets_every: int = 10) -> Tuple[str, List[str]]:
+    """
+    ТТЗ в форматах, которые понимает parse_ttz_requirements:
+    "Раздел N. ...", номерные строки "N.M.K. текст" и заголовки
+    "N.M.K Требования к ..." с буллетами "- ...".
+    Возвращает (текст, номера номерных требований).
+    """
+    rnd = random.Random(seed)
+    lines: List[str] = []
+    nums: List[str] = []
+    made = 0
+    sec = 0
+    while made < n_reqs:
+        sec += 1
+        lines.append(f"Раздел {sec}. {_phrase(rnd, 3).capitalize()}")
+        for sub in range(1, 11):
+            if made >= n_reqs:
+                break
+            if sub % bullets_every == 0:
+                lines.append(f"{sec}.{sub}.1 Требования к {_phrase(rnd, 2)}")
+                for _ in range(min(3, n_reqs - made)):
+                    lines.append(f"- {_phrase(rnd, 3).capitalize()} {_constraint(rnd)}")
+                    made += 1
+                continue
+            num = f"{sec}.{sub}.{rnd.randint(1, 9)}"
+            lines.append(f"{num}. {_phrase(rnd, 5).capitalize()} должна обеспечивать {_constraint(rnd)}.")
+            nums.append(num)
+            made += 1
+    return "\n".join(lines), nums
+
+def make_kd(n_paras: int, ref_nums: List[str], seed: int = 0, ref_rate: float = 0.1) -> str:
+    """
+    КД из n_paras абзацев (через пустую строку) с числами/единицами
+    и вставленными явными ссылками "п. X ТЗ" / "пункт X" на долю ref_rate абзацев.
+    """
+    rnd = random.Random(seed + 1)
+    paras: List[str] = []
+    for _ in range(n_paras):
+        p = f"{_phrase(rnd, 25).capitalize()} {_constraint(rnd)}, {_constraint(rnd)}."
+        if ref_nums and rnd.random() < ref_rate:
+            num = rnd.choice(ref_nums)
+            p += rnd.choice([f" Выполнено согласно п. {num} ТЗ.", f" См. пункт {num}."])
+        paras.append(p)
+    return "\n\n".join(paras)
+
+def to_pdf_bytes(text: str, lines_per_page: int = 28, width: int = 70) -> bytes:
+    """PDF с текстовым слоем; встроенный шрифт china-s покрывает кириллицу"""
+    import textwrap
+
+    import fitz  # PyMuPDF
+
+    lines: List[str] = []
+    for line in text.splitlines():
+        lines.extend(textwrap.wrap(line, width) or [""])
+
+    doc = fitz.open()
+    for a in range(0, len(lines), lines_per_page):
+        page = doc.new_page()
+        page.insert_text((36, 36), "\n".join(lines[a:a + lines_per_page]), fontsize=7, fontname="china-s")
+    return doc.tobytes()
+
+def to_docx_bytes(text: str, table_every: int = 20) -> bytes:
+    """DOCX: абзац на строку; каждая table_every-я непустая строка — строкой таблицы (первое слово | остальное)"""
+    import io
+
+    from docx import Document
+
+    doc = Document()
+    n = 0
+    for line in text.splitlines():
+        if line.strip():
+            n += 1
+        if line.strip() and n % table_every == 0:
+            table = doc.add_table(rows=1, cols=2)
+            name, _, value = line.partition(" ")
+            table.cell(0, 0).text = name
+            table.cell(0, 1).text = value
+        else:
+            doc.add_paragraph(line)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
@@ -1,109 +1,881 @@
 # database.py
 import sqlite3
+import hashlib
 import json
+import re
+import functools
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 import pandas as pd
 import os
 
+from pipeline.match_kd import EVIDENCE_CUT_MARK, diff_summary
+
+def _pooled(method):
+    """Метод работает с соединением из пула (HistoryDatabase.connection) на время вызова"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.connection():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class HistoryDatabase:
+    # Сколько ждать чужую запись, прежде чем вернуть "database is locked"
+    BUSY_TIMEOUT_MS = 30000
+    # Сколько распакованных текстов КД держать в памяти (общий кэш экземпляра)
+    DOCUMENT_CACHE_SIZE = 4
+    # Сколько простаивающих соединений держать в пуле (лишние закрываются при возврате)
+    POOL_SIZE = 4
+    # Сколько первых символов фрагмента КД хранится в строке для полнотекстового поиска
+    SEARCH_EVIDENCE_CHARS = 256
+    # PRAGMA user_version после переноса results_json в comparison_rows (дальше проверка не нужна)
+    RESULTS_MIGRATED_VERSION = 1
+
     def __init__(self, db_path="comparison_history.db"):
         self.db_path = db_path
+        # Пул соединений, общий для всех потоков: экземпляр один на процесс (st.cache_resource),
+        # а Streamlit выполняет каждый rerun в новом потоке
+        self._pool: List[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        # Соединение, взятое из пула текущим потоком, и глубина вложенности connection/transaction
+        self._local = threading.local()
+        # Распакованные тексты КД (общие для потоков)
+        self._documents: "OrderedDict[int, str]" = OrderedDict()
+        self._documents_lock = threading.Lock()
         self.init_database()
 
+    def _new_connection(self) -> sqlite3.Connection:
+        # isolation_level=None: транзакции открываем сами в transaction();
+        # check_same_thread=False: соединение из пула может достаться другому потоку
+        conn = sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                               check_same_thread=False)
+        # Действует только для новой БД (до создания таблиц); старую переводит manage_db --convert-vacuum
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -32000")
+        # Фрагмент КД и различия для строк, хранящих только отрезок (см. _row_select)
+        conn.create_function("kd_slice", 4, self._kd_slice, deterministic=True)
+        conn.create_function("kd_diff", 2, self._kd_diff, deterministic=True)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Соединение из пула на время блока (новое, если пул пуст); при выходе возвращается в пул.
+        Вложенные вызовы в том же потоке (в том числе из kd_slice) получают то же соединение.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.holds += 1
+            try:
+                yield conn
+            finally:
+                self._local.holds -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.holds = 1
+        self._local.depth = 0
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._pool_lock:
+            if self._pool:
+                return self._pool.pop()
+        return self._new_connection()
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        with self._pool_lock:
+            if len(self._pool) < self.POOL_SIZE:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение, взятое текущим потоком (только внутри connection / transaction / @_pooled)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            raise RuntimeError("Нет соединения: используйте HistoryDatabase.connection()")
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Одна транзакция на несколько операций: COMMIT при выходе, ROLLBACK при исключении.
+        Берёт блокировку записи сразу (BEGIN IMMEDIATE), вложенные вызовы входят во внешнюю.
+        """
+        with self.connection() as conn:
+            if self._local.depth:
+                self._local.depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._local.depth -= 1
+                return
+
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.depth = 1
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._local.depth = 0
+
+    def close(self):
+        """Закрывает простаивающие соединения пула (взятые сейчас закроются при возврате сверх POOL_SIZE)"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+
     def init_database(self):
         """Инициализация таблиц в базе данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        fts_created = False
+        with self.transaction() as conn:
+            cursor = conn.cursor()
 
-        # Таблица для истории сравнений
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS comparisons (
-                                                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                                                  timestamp TEXT NOT NULL,
-                                                                  ttz_filename TEXT NOT NULL,
-                                                                  kd_filename TEXT NOT NULL,
-                                                                  total_requirements INTEGER,
-                                                                  found_count INTEGER,
-                                                                  ok_count INTEGER,
-                                                                  partial_count INTEGER,
-                                                                  not_found_count INTEGER,
-                                                                  results_json TEXT NOT NULL,
-                                                                  user_name TEXT DEFAULT 'Аноним'
-                       )
-                       ''')
+            # Таблица для истории сравнений
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS comparisons (
+                                                                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                                      timestamp TEXT NOT NULL,
+                                                                      ttz_filename TEXT NOT NULL,
+                                                                      kd_filename TEXT NOT NULL,
+                                                                      total_requirements INTEGER,
+                                                                      found_count INTEGER,
+                                                                      ok_count INTEGER,
+                                                                      partial_count INTEGER,
+                                                                      not_found_count INTEGER,
+                                                                      results_json TEXT NOT NULL,
+                                                                      user_name TEXT DEFAULT 'Аноним'
+                           )
+                           ''')
 
-        # Таблица для комментариев
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS comments (
-                                                               id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                                               comparison_id INTEGER NOT NULL,
-                                                               timestamp TEXT NOT NULL,
-                                                               user_name TEXT NOT NULL,
-                                                               comment_text TEXT NOT NULL,
-                                                               FOREIGN KEY (comparison_id) REFERENCES comparisons (id) ON DELETE CASCADE
+            # Миграция: хэши входных файлов и версия пайплайна для переиспользования результатов
+            cursor.execute("PRAGMA table_info(comparisons)")
+            columns = {row[1] for row in cursor.fetchall()}
+            for name, decl in (
+                    ("ttz_hash", "TEXT"),
+                    ("kd_hash", "TEXT"),
+                    ("pipeline_version", "TEXT"),
+                    ("reused_from", "INTEGER"),
+                    ("state", "TEXT NOT NULL DEFAULT 'done'"),
+            ):
+                if name not in columns:
+                    cursor.execute(f"ALTER TABLE comparisons ADD COLUMN {name} {decl}")
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comparisons_memo
+                               ON comparisons (ttz_hash, kd_hash, pipeline_version)
+                           ''')
+            # Для постраничной истории (keyset по timestamp, id) и фильтра по файлу ТТЗ
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comparisons_timestamp
+                               ON comparisons (timestamp, id)
+                           ''')
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comparisons_ttz_filename
+                               ON comparisons (ttz_filename)
+                           ''')
+
+            # Тексты КД, на которые ссылаются строки результата (сжаты zlib, один экземпляр на текст)
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS documents (
+                               id INTEGER PRIMARY KEY,
+                               hash TEXT NOT NULL UNIQUE,
+                               length INTEGER NOT NULL,
+                               text_z BLOB NOT NULL
                            )
-                       ''')
+                           ''')
 
-        conn.commit()
-        conn.close()
+            # Результаты по требованиям: одна строка на требование.
+            # evidence/diff = NULL — фрагмент хранится отрезком [kd_start, kd_end) текста kd_doc
+            # (kd_cut — фрагмент обрезан, к отрезку добавляется EVIDENCE_CUT_MARK)
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS comparison_rows (
+                               id INTEGER PRIMARY KEY,
+                               comparison_id INTEGER NOT NULL,
+                               row_idx INTEGER NOT NULL,
+                               req_id TEXT,
+                               section TEXT,
+                               req_text TEXT,
+                               status TEXT,
+                               match_type TEXT,
+                               evidence TEXT,
+                               numbers_covered TEXT,
+                               diff TEXT,
+                               kd_doc INTEGER REFERENCES documents (id),
+                               kd_start INTEGER,
+                               kd_end INTEGER,
+                               kd_cut INTEGER,
+                               evidence_head TEXT,
+                               UNIQUE (comparison_id, row_idx),
+                               FOREIGN KEY (comparison_id) REFERENCES comparisons (id) ON DELETE CASCADE
+                           )
+                           ''')
+            cursor.execute("PRAGMA table_info(comparison_rows)")
+            columns = {row[1] for row in cursor.fetchall()}
+            for name, decl in (
+                    ("kd_doc", "INTEGER REFERENCES documents (id)"),
+                    ("kd_start", "INTEGER"),
+                    ("kd_end", "INTEGER"),
+                    ("kd_cut", "INTEGER"),
+                    ("evidence_head", "TEXT"),
+            ):
+                if name not in columns:
+                    cursor.execute(f"ALTER TABLE comparison_rows ADD COLUMN {name} {decl}")
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comparison_rows_status
+                               ON comparison_rows (comparison_id, status, row_idx)
+                           ''')
+            # Для проверки внешнего ключа и поиска неиспользуемых текстов при очистке
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comparison_rows_doc
+                               ON comparison_rows (kd_doc)
+                           ''')
+
+            # Полнотекстовый индекс по строкам результата (rowid = comparison_rows.id).
+            # External content над comparison_rows: тексты не копируются, фрагмент КД индексируется
+            # по столбцу evidence_head (первые SEARCH_EVIDENCE_CHARS символов) — схема не зависит
+            # от функций Python (kd_slice), сниппеты не распаковывают КД.
+            # Заполняется явно в _insert_rows, удаление — триггером (в т.ч. каскадное)
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'rows_fts'")
+            row = cursor.fetchone()
+            if row and "content = 'comparison_rows'" not in row[0]:
+                # индекс прежних версий (своя копия фрагментов или представление с kd_slice): пересоздаётся
+                cursor.execute("DROP TRIGGER IF EXISTS comparison_rows_fts_delete")
+                cursor.execute("DROP TABLE rows_fts")
+                row = None
+            cursor.execute("DROP VIEW IF EXISTS rows_search_source")
+            fts_created = row is None
+            try:
+                cursor.execute('''
+                               CREATE VIRTUAL TABLE IF NOT EXISTS rows_fts USING fts5 (
+                                   req_text, section, evidence_head,
+                                   content = 'comparison_rows',
+                                   content_rowid = 'id',
+                                   tokenize = 'unicode61 remove_diacritics 2',
+                                   prefix = '3'
+                               )
+                               ''')
+                # external content: из индекса удаляются те же значения, что были в него записаны
+                cursor.execute('''
+                               CREATE TRIGGER IF NOT EXISTS comparison_rows_fts_delete
+                                   AFTER DELETE ON comparison_rows
+                               BEGIN
+                                   INSERT INTO rows_fts (rows_fts, rowid, req_text, section, evidence_head)
+                                   VALUES ('delete', old.id, old.req_text, old.section, old.evidence_head);
+                               END
+                               ''')
+                self.has_fts = True
+            except sqlite3.OperationalError:
+                # SQLite собран без FTS5: история работает, поиск недоступен
+                self.has_fts = False
+                fts_created = False
+
+            # Промежуточная таблица прежних версий: строки теперь пишутся сразу в comparison_rows
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pending_rows'")
+            if cursor.fetchone():
+                cursor.execute("SELECT comparison_id, row_idx, row_json FROM pending_rows")
+                for comparison_id, row_idx, row_json in cursor.fetchall():
+                    self._insert_rows(cursor, comparison_id, [json.loads(row_json)], row_idx)
+                cursor.execute("DROP TABLE pending_rows")
+
+            # Профиль выполнения: время по стадиям пайплайна и распределение по требованиям
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS comparison_profile (
+                               comparison_id INTEGER NOT NULL,
+                               stage TEXT NOT NULL,
+                               calls INTEGER,
+                               items INTEGER,
+                               seconds REAL,
+                               p50 REAL,
+                               p95 REAL,
+                               max_seconds REAL,
+                               slowest_json TEXT,
+                               PRIMARY KEY (comparison_id, stage),
+                               FOREIGN KEY (comparison_id) REFERENCES comparisons (id) ON DELETE CASCADE
+                           )
+                           ''')
+
+            # Таблица для комментариев
+            cursor.execute('''
+                           CREATE TABLE IF NOT EXISTS comments (
+                                                                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                                   comparison_id INTEGER NOT NULL,
+                                                                   timestamp TEXT NOT NULL,
+                                                                   user_name TEXT NOT NULL,
+                                                                   comment_text TEXT NOT NULL,
+                                                                   FOREIGN KEY (comparison_id) REFERENCES comparisons (id) ON DELETE CASCADE
+                               )
+                           ''')
+            cursor.execute('''
+                           CREATE INDEX IF NOT EXISTS idx_comments_comparison
+                               ON comments (comparison_id, timestamp)
+                           ''')
+
+        # перенос старых блобов — своими короткими транзакциями, не под схемной
+        with self.connection() as conn:
+            migrated = conn.execute("PRAGMA user_version").fetchone()[0] >= self.RESULTS_MIGRATED_VERSION
+        if not migrated:
+            self._migrate_results_json()
+
+        if fts_created:
+            self.rebuild_search_index()
+
+    # Соответствие ключей строки результата (как их отдаёт compare_requirements) столбцам comparison_rows
+    ROW_COLUMNS = (
+        ("req_id", "req_id"),
+        ("ttz_section", "section"),
+        ("req_text", "req_text"),
+        ("status", "status"),
+        ("match_type", "match_type"),
+        ("kd_evidence", "evidence"),
+        ("numbers_covered", "numbers_covered"),
+        ("diff", "diff"),
+    )
+    # Отрезок фрагмента в сохранённом тексте КД (ключи строки совпадают со столбцами)
+    SPAN_COLUMNS = ("kd_doc", "kd_start", "kd_end", "kd_cut")
+
+    @staticmethod
+    def _evidence_sql(alias: str = "") -> str:
+        """Фрагмент КД строки: сохранённый текст или (для строк с отрезком) срез текста kd_doc"""
+        p = f"{alias}." if alias else ""
+        return f"COALESCE({p}evidence, kd_slice({p}kd_doc, {p}kd_start, {p}kd_end, {p}kd_cut))"
+
+    @classmethod
+    def _row_select(cls, alias: str = "") -> List[str]:
+        """Выражения SELECT для столбцов ROW_COLUMNS с восстановлением evidence и diff по отрезку"""
+        p = f"{alias}." if alias else ""
+        exprs = {
+            "evidence": cls._evidence_sql(alias),
+            "diff": f"COALESCE({p}diff, kd_diff({p}req_text, {cls._evidence_sql(alias)}))",
+        }
+        return [exprs.get(col, p + col) for _, col in cls.ROW_COLUMNS]
+
+    @_pooled
+    def save_document(self, text: str) -> int:
+        """Сохраняет текст КД (один раз на одинаковый текст) и возвращает его id для kd_doc строк"""
+        data = text.encode("utf-8")
+        doc_hash = hashlib.sha256(data).hexdigest()
+        cursor = self._connect().cursor()
+        cursor.execute("SELECT id FROM documents WHERE hash = ?", (doc_hash,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+
+        text_z = zlib.compress(data, 6)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT OR IGNORE INTO documents (hash, length, text_z) VALUES (?, ?, ?)",
+                           (doc_hash, len(text), text_z))
+            cursor.execute("SELECT id FROM documents WHERE hash = ?", (doc_hash,))
+            return cursor.fetchone()[0]
+
+    @_pooled
+    def get_document(self, doc_id: int) -> Optional[str]:
+        """Текст КД по id (последние DOCUMENT_CACHE_SIZE распакованных текстов кэшируются)"""
+        cache = self._documents
+        with self._documents_lock:
+            if doc_id in cache:
+                cache.move_to_end(doc_id)
+                return cache[doc_id]
+
+        row = self._connect().execute("SELECT text_z FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        if row is None:
+            return None
+        text = zlib.decompress(row[0]).decode("utf-8")
+        with self._documents_lock:
+            cache[doc_id] = text
+            while len(cache) > self.DOCUMENT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return text
+
+    def _kd_slice(self, doc_id: Optional[int], start: Optional[int], end: Optional[int],
+                  cut: Optional[int] = None) -> Optional[str]:
+        if doc_id is None or start is None or end is None:
+            return None
+        text = self.get_document(doc_id)
+        if text is None:
+            return None
+        return text[start:end] + (EVIDENCE_CUT_MARK if cut else "")
+
+    @staticmethod
+    def _kd_diff(req_text: Optional[str], evidence: Optional[str]) -> str:
+        return diff_summary(req_text or "", evidence) if evidence else ""
+
+    def _migrate_results_json(self, batch: int = 50):
+        """
+        Переносит старые блобы results_json в comparison_rows: по batch сравнений
+        в отдельной транзакции, чтобы не держать блокировку записи на всё время переноса.
+        По завершении ставит PRAGMA user_version — следующие запуски проверку пропускают.
+        """
+        while True:
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                               SELECT id, results_json FROM comparisons
+                               WHERE results_json NOT IN ('', '[]')
+                               LIMIT ?
+                               ''', (batch,))
+                found = cursor.fetchall()
+                if not found:
+                    cursor.execute(f"PRAGMA user_version = {self.RESULTS_MIGRATED_VERSION}")
+                    return
+                for comparison_id, results_json in found:
+                    self._insert_rows(cursor, comparison_id, json.loads(results_json), 0)
+                    cursor.execute("UPDATE comparisons SET results_json = '' WHERE id = ?", (comparison_id,))
+
+    def _evidence_head(self, row: Dict[str, Any]) -> Optional[str]:
+        """Начало фрагмента КД строки для полнотекстового поиска"""
+        evidence = row.get("kd_evidence")
+        if evidence is None:
+            evidence = self._kd_slice(row.get("kd_doc"), row.get("kd_start"), row.get("kd_end"), row.get("kd_cut"))
+        return evidence[:self.SEARCH_EVIDENCE_CHARS] if evidence is not None else None
+
+    def _insert_rows(self, cursor: sqlite3.Cursor, comparison_id: int,
+                     rows: List[Dict[str, Any]], start_idx: int):
+        keys = [key for key, _ in self.ROW_COLUMNS] + list(self.SPAN_COLUMNS)
+        cols = ", ".join([col for _, col in self.ROW_COLUMNS] + list(self.SPAN_COLUMNS))
+        marks = ", ".join("?" for _ in keys)
+        cursor.executemany(
+            f"INSERT INTO comparison_rows (comparison_id, row_idx, {cols}, evidence_head) VALUES (?, ?, {marks}, ?)",
+            [
+                (comparison_id, start_idx + i, *(r.get(key) for key in keys), self._evidence_head(r))
+                for i, r in enumerate(rows)
+            ]
+        )
+        if self.has_fts:
+            cursor.execute('''
+                           INSERT INTO rows_fts (rowid, req_text, section, evidence_head)
+                           SELECT id, req_text, section, evidence_head FROM comparison_rows
+                           WHERE comparison_id = ? AND row_idx >= ? AND row_idx < ?
+                           ''', (comparison_id, start_idx, start_idx + len(rows)))
+
+    def _update_counts(self, cursor: sqlite3.Cursor, comparison_id: int):
+        """Пересчитывает счётчики сравнения по comparison_rows"""
+        cursor.execute('''
+                       UPDATE comparisons
+                       SET (total_requirements, found_count, ok_count, partial_count, not_found_count) = (
+                           SELECT COUNT(*),
+                                  COALESCE(SUM(status IN ('OK', 'PARTIAL', 'FOUND')), 0),
+                                  COALESCE(SUM(status = 'OK'), 0),
+                                  COALESCE(SUM(status = 'PARTIAL'), 0),
+                                  COALESCE(SUM(status = 'NOT_FOUND'), 0)
+                           FROM comparison_rows WHERE comparison_id = ?
+                       )
+                       WHERE id = ?
+                       ''', (comparison_id, comparison_id))
 
     def save_comparison(self, ttz_filename: str, kd_filename: str,
-                        df_results: pd.DataFrame, user_name: str = "Аноним") -> int:
+                        df_results: pd.DataFrame, user_name: str = "Аноним",
+                        ttz_hash: Optional[str] = None, kd_hash: Optional[str] = None,
+                        pipeline_version: Optional[str] = None) -> int:
         """Сохраняет результаты сравнения в БД"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           INSERT INTO comparisons
+                           (timestamp, ttz_filename, kd_filename, results_json, user_name,
+                            ttz_hash, kd_hash, pipeline_version)
+                           VALUES (?, ?, ?, '', ?, ?, ?, ?)
+                           ''', (
+                               datetime.now().isoformat(),
+                               ttz_filename,
+                               kd_filename,
+                               user_name,
+                               ttz_hash,
+                               kd_hash,
+                               pipeline_version
+                           ))
+
+            comparison_id = cursor.lastrowid
+            self._insert_rows(cursor, comparison_id, df_results.to_dict(orient="records"), 0)
+            self._update_counts(cursor, comparison_id)
+
+        return comparison_id
+
+    def start_comparison(self, ttz_filename: str, kd_filename: str, user_name: str = "Аноним",
+                         ttz_hash: Optional[str] = None, kd_hash: Optional[str] = None,
+                         pipeline_version: Optional[str] = None) -> int:
+        """
+        Создаёт запись о сравнении в состоянии 'running'.
+        Строки дописываются через append_rows, итог фиксирует finish_comparison.
+        До этого сравнение не видно в истории.
+        """
+        with self.transaction() as conn:
+            cursor = conn.cursor()
 
-        # Подсчет статистики
-        total = len(df_results)
-        found = int((df_results["status"].isin(["OK","PARTIAL","FOUND"])).sum())
-        ok_count = int((df_results["status"] == "OK").sum())
-        partial_count = int((df_results["status"] == "PARTIAL").sum())
-        not_found_count = int((df_results["status"] == "NOT_FOUND").sum())
+            cursor.execute('''
+                           INSERT INTO comparisons
+                           (timestamp, ttz_filename, kd_filename, results_json, user_name,
+                            ttz_hash, kd_hash, pipeline_version, state)
+                           VALUES (?, ?, ?, '', ?, ?, ?, ?, 'running')
+                           ''', (
+                               datetime.now().isoformat(),
+                               ttz_filename,
+                               kd_filename,
+                               user_name,
+                               ttz_hash,
+                               kd_hash,
+                               pipeline_version
+                           ))
 
-        # Преобразуем DataFrame в JSON для хранения
-        results_json = df_results.to_json(orient="records", force_ascii=False, indent=2)
+            comparison_id = cursor.lastrowid
+
+        return comparison_id
+
+    def append_rows(self, comparison_id: int, rows: List[Dict[str, Any]]):
+        """Дописывает очередную пачку строк результата к незавершённому сравнению"""
+        if not rows:
+            return
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT COALESCE(MAX(row_idx) + 1, 0) FROM comparison_rows WHERE comparison_id = ?",
+                           (comparison_id,))
+            self._insert_rows(cursor, comparison_id, rows, cursor.fetchone()[0])
+
+    def finish_comparison(self, comparison_id: int):
+        """Считает статистику по дописанным строкам и открывает сравнение в истории"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            self._update_counts(cursor, comparison_id)
+            cursor.execute("UPDATE comparisons SET state = 'done' WHERE id = ?", (comparison_id,))
+
+    def discard_comparison(self, comparison_id: int):
+        """
+        Удаляет незавершённое (упавшее) сравнение вместе с уже записанными строками;
+        строки индекса поиска, профиль и комментарии удаляются каскадно
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM comparisons WHERE id = ? AND state = 'running'", (comparison_id,))
+
+    @_pooled
+    def find_comparison(self, ttz_hash: str, kd_hash: str, pipeline_version: str) -> Optional[int]:
+        """Ищет последнее полноценное сравнение той же пары файлов той же версией пайплайна"""
+        cursor = self._connect().cursor()
 
         cursor.execute('''
-                       INSERT INTO comparisons
-                       (timestamp, ttz_filename, kd_filename, total_requirements,
-                        found_count, ok_count, partial_count, not_found_count,
-                        results_json, user_name)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                       ''', (
-                           datetime.now().isoformat(),
-                           ttz_filename,
-                           kd_filename,
-                           total,
-                           found,
-                           ok_count,
-                           partial_count,
-                           not_found_count,
-                           results_json,
-                           user_name
-                       ))
-
-        comparison_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+                       SELECT id FROM comparisons
+                       WHERE ttz_hash = ? AND kd_hash = ? AND pipeline_version = ?
+                         AND reused_from IS NULL AND state = 'done'
+                       ORDER BY id DESC
+                       LIMIT 1
+                       ''', (ttz_hash, kd_hash, pipeline_version))
+
+        row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    def save_rerun(self, source_id: int, ttz_filename: str, kd_filename: str,
+                   user_name: str = "Аноним") -> int:
+        """
+        Записывает повторный запуск без копии результатов:
+        статистика берётся из исходного сравнения, результаты читаются по reused_from
+        """
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                           INSERT INTO comparisons
+                           (timestamp, ttz_filename, kd_filename, total_requirements,
+                            found_count, ok_count, partial_count, not_found_count,
+                            results_json, user_name, ttz_hash, kd_hash, pipeline_version, reused_from)
+                           SELECT ?, ?, ?, total_requirements,
+                                  found_count, ok_count, partial_count, not_found_count,
+                                  '', ?, ttz_hash, kd_hash, pipeline_version, id
+                           FROM comparisons
+                           WHERE id = ?
+                           ''', (
+                               datetime.now().isoformat(),
+                               ttz_filename,
+                               kd_filename,
+                               user_name,
+                               source_id
+                           ))
+
+            comparison_id = cursor.lastrowid
 
         return comparison_id
 
+    @staticmethod
+    def _history_filter(date_from: Optional[str] = None, date_to: Optional[str] = None,
+                        filename: Optional[str] = None,
+                        user_name: Optional[str] = None) -> Tuple[str, List[Any]]:
+        """
+        WHERE для истории: только завершённые сравнения плюс фильтры.
+        date_from/date_to — ISO-строки, [date_from, date_to); filename — начало имени файла ТТЗ.
+        """
+        where = ["state = 'done'"]
+        params: List[Any] = []
+        if date_from:
+            where.append("timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("timestamp < ?")
+            params.append(date_to)
+        if filename:
+            # диапазон по префиксу вместо LIKE — так работает индекс по ttz_filename
+            where.append("ttz_filename >= ? AND ttz_filename < ?")
+            params += [filename, filename + "\U0010ffff"]
+        if user_name:
+            where.append("user_name = ?")
+            params.append(user_name)
+        return " AND ".join(where), params
+
+    @_pooled
+    def count_comparisons(self, **filters) -> int:
+        """Число сравнений в истории (фильтры — как у list_comparisons)"""
+        where, params = self._history_filter(**filters)
+        cursor = self._connect().cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM comparisons WHERE {where}", params)
+        return cursor.fetchone()[0]
+
+    @_pooled
+    def list_comparisons(self, limit: int = 50, after: Optional[Tuple[str, int]] = None,
+                         **filters) -> List[Dict[str, Any]]:
+        """
+        Страница истории, от новых к старым.
+        after — (timestamp, id) последней записи предыдущей страницы (keyset-пагинация).
+        Фильтры: date_from, date_to, filename, user_name.
+        """
+        where, params = self._history_filter(**filters)
+        if after:
+            where += " AND (timestamp, id) < (?, ?)"
+            params += list(after)
+
+        cursor = self._connect().cursor()
+        cursor.execute(f'''
+                       SELECT id, timestamp, ttz_filename, kd_filename,
+                           total_requirements, found_count, ok_count,
+                           partial_count, not_found_count, user_name
+                       FROM comparisons
+                       WHERE {where}
+                       ORDER BY timestamp DESC, id DESC
+                       LIMIT ?
+                       ''', params + [limit])
+
+        return [
+            {
+                'id': row[0],
+                'timestamp': row[1],
+                'ttz_filename': row[2],
+                'kd_filename': row[3],
+                'total': row[4],
+                'found': row[5],
+                'ok': row[6],
+                'partial': row[7],
+                'not_found': row[8],
+                'user_name': row[9]
+            }
+            for row in cursor.fetchall()
+        ]
+
+    @_pooled
+    def get_history_stats(self, **filters) -> Dict[str, Any]:
+        """Сводная статистика по истории (агрегатами в SQL) и число найденных по дням"""
+        where, params = self._history_filter(**filters)
+        cursor = self._connect().cursor()
+
+        cursor.execute(f'''
+                       SELECT COUNT(*), COALESCE(SUM(total_requirements), 0),
+                              COALESCE(SUM(found_count), 0), AVG(found_count)
+                       FROM comparisons
+                       WHERE {where}
+                       ''', params)
+        count, total, found, avg_found = cursor.fetchone()
+
+        cursor.execute(f'''
+                       SELECT substr(timestamp, 1, 10) AS day, SUM(found_count)
+                       FROM comparisons
+                       WHERE {where}
+                       GROUP BY day
+                       ORDER BY day
+                       ''', params)
+
+        return {
+            'count': count,
+            'total': total,
+            'found': found,
+            'avg_found': avg_found or 0.0,
+            'by_day': [{'date': day, 'found': n} for day, n in cursor.fetchall()],
+        }
+
+    def rebuild_search_index(self, batch: int = 5000) -> int:
+        """Перестраивает полнотекстовый индекс по всем строкам истории (пачками по batch строк)"""
+        if not self.has_fts:
+            raise RuntimeError("SQLite собран без FTS5: полнотекстовый поиск недоступен")
+
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO rows_fts (rows_fts) VALUES ('delete-all')")
+
+        done = 0
+        last_id = 0
+        while True:
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT MAX(id) FROM (SELECT id FROM comparison_rows WHERE id > ? ORDER BY id LIMIT ?)",
+                               (last_id, batch))
+                upto = cursor.fetchone()[0]
+                if upto is None:
+                    return done
+                # начало фрагмента пересчитывается (у строк прежних версий его нет)
+                cursor.execute(f'''
+                               UPDATE comparison_rows
+                               SET evidence_head = substr({self._evidence_sql()}, 1, {self.SEARCH_EVIDENCE_CHARS})
+                               WHERE id > ? AND id <= ?
+                               ''', (last_id, upto))
+                cursor.execute('''
+                               INSERT INTO rows_fts (rowid, req_text, section, evidence_head)
+                               SELECT id, req_text, section, evidence_head FROM comparison_rows
+                               WHERE id > ? AND id <= ?
+                               ''', (last_id, upto))
+                done += cursor.rowcount
+                last_id = upto
+
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        """Запрос пользователя -> запрос FTS5: все слова (по началу слова), без спецсинтаксиса"""
+        return " ".join(f'"{w}"*' for w in re.findall(r"\w+", text))
+
+    @_pooled
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        Поиск по тексту требований, разделам и доказательствам КД (первые SEARCH_EVIDENCE_CHARS
+        символов фрагмента) во всей истории. Результаты ранжированы по bm25, со сниппетами ([совпадение]).
+        """
+        if not self.has_fts:
+            raise RuntimeError("SQLite собран без FTS5: полнотекстовый поиск недоступен")
+        match = self._fts_query(query)
+        if not match:
+            return []
+
+        cursor = self._connect().cursor()
+        # сначала ранжирование и LIMIT только по bm25, сниппеты — лишь для строк страницы
+        cursor.execute('''
+                       SELECT c.id, c.timestamp, c.ttz_filename, c.kd_filename,
+                              r.req_id, r.section, r.status,
+                              snippet(rows_fts, 0, '[', ']', '…', 16),
+                              snippet(rows_fts, 2, '[', ']', '…', 16),
+                              hit.score
+                       FROM (
+                           SELECT rows_fts.rowid AS id, bm25(rows_fts) AS score
+                           FROM rows_fts
+                           JOIN comparison_rows r ON r.id = rows_fts.rowid
+                           JOIN comparisons c ON c.id = r.comparison_id
+                           WHERE rows_fts MATCH ? AND c.state = 'done'
+                           ORDER BY score
+                           LIMIT ? OFFSET ?
+                       ) hit
+                       JOIN rows_fts ON rows_fts.rowid = hit.id AND rows_fts MATCH ?
+                       JOIN comparison_rows r ON r.id = hit.id
+                       JOIN comparisons c ON c.id = r.comparison_id
+                       ORDER BY hit.score
+                       ''', (match, limit, offset, match))
+
+        return [
+            {
+                'comparison_id': row[0],
+                'timestamp': row[1],
+                'ttz_filename': row[2],
+                'kd_filename': row[3],
+                'req_id': row[4],
+                'section': row[5],
+                'status': row[6],
+                'req_snippet': row[7],
+                'evidence_snippet': row[8],
+                'score': row[9]
+            }
+            for row in cursor.fetchall()
+        ]
+
+    # Столбцы выгрузки истории: сводка сравнения и (опционально) строки результата
+    EXPORT_COLUMNS = ("id", "timestamp", "ttz_filename", "kd_filename", "user_name",
+                      "total_requirements", "found_count", "ok_count", "partial_count",
+                      "not_found_count", "reused_from", "pipeline_version")
+
+    def iter_export(self, include_rows: bool = False, chunk_size: int = 1000,
+                    ids: Optional[List[int]] = None, **filters) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Выгрузка истории пачками по chunk_size записей (курсор читается через fetchmany,
+        вся история в память не загружается). include_rows — по записи на каждое требование
+        (фрагменты КД и различия восстанавливаются по отрезкам при чтении).
+        Фильтры: ids и date_from/date_to (как у list_comparisons).
+        """
+        where, params = self._history_filter(
+            date_from=filters.get("date_from"), date_to=filters.get("date_to")
+        )
+        if ids:
+            where += f" AND c.id IN ({', '.join('?' for _ in ids)})"
+            params += list(ids)
+
+        cols = [f"c.{c}" for c in self.EXPORT_COLUMNS]
+        keys = list(self.EXPORT_COLUMNS)
+        if include_rows:
+            cols += ["r.row_idx"] + self._row_select("r")
+            keys += ["row_idx"] + [key for key, _ in self.ROW_COLUMNS]
+            # для повторного запуска строки берутся из исходного сравнения;
+            # сравнение без строк (например, в ТТЗ не нашлось требований) выгружается одной записью
+            sql = f'''
+                  SELECT {", ".join(cols)}
+                  FROM comparisons c
+                  LEFT JOIN comparison_rows r ON r.comparison_id = COALESCE(c.reused_from, c.id)
+                  WHERE {where}
+                  ORDER BY c.id, r.row_idx
+                  '''
+        else:
+            sql = f"SELECT {', '.join(cols)} FROM comparisons c WHERE {where} ORDER BY c.id"
+
+        # своё соединение из пула, не привязанное к потоку: генератор могут дочитать
+        # или закрыть из другого потока, а запросы между порциями идут через connection()
+        conn = self._acquire()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    return
+                yield [dict(zip(keys, row)) for row in chunk]
+        finally:
+            cursor.close()
+            self._release(conn)
+
+    @_pooled
     def get_all_comparisons(self) -> List[Dict[str, Any]]:
         """Получает список всех сравнений"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._connect().cursor()
 
         cursor.execute('''
                        SELECT id, timestamp, ttz_filename, kd_filename,
                            total_requirements, found_count, ok_count,
                            partial_count, not_found_count, user_name
                        FROM comparisons
+                       WHERE state = 'done'
                        ORDER BY timestamp DESC
                        ''')
 
         rows = cursor.fetchall()
-        conn.close()
 
         comparisons = []
         for row in rows:
@@ -122,21 +894,20 @@ class HistoryDatabase:
 
         return comparisons
 
+    @_pooled
     def get_comparison_details(self, comparison_id: int) -> Optional[Dict[str, Any]]:
         """Получает детали конкретного сравнения"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._connect().cursor()
 
         cursor.execute('''
                        SELECT id, timestamp, ttz_filename, kd_filename,
                            total_requirements, found_count, ok_count,
-                           partial_count, not_found_count, results_json, user_name
+                           partial_count, not_found_count, user_name, reused_from
                        FROM comparisons
                        WHERE id = ?
                        ''', (comparison_id,))
 
         row = cursor.fetchone()
-        conn.close()
 
         if row:
             return {
@@ -149,33 +920,148 @@ class HistoryDatabase:
                 'ok': row[6],
                 'partial': row[7],
                 'not_found': row[8],
-                'results_json': json.loads(row[9]),
-                'user_name': row[10]
+                'user_name': row[9],
+                'reused_from': row[10]
             }
         return None
 
+    def _rows_owner(self, cursor: sqlite3.Cursor, comparison_id: int) -> int:
+        """Для повторного запуска строки результата лежат в исходном сравнении"""
+        cursor.execute("SELECT COALESCE(reused_from, id) FROM comparisons WHERE id = ?", (comparison_id,))
+        row = cursor.fetchone()
+        return row[0] if row else comparison_id
+
+    @_pooled
+    def count_comparison_rows(self, comparison_id: int, status: Optional[str] = None) -> int:
+        """Число строк результата (с фильтром по статусу)"""
+        cursor = self._connect().cursor()
+        owner = self._rows_owner(cursor, comparison_id)
+
+        if status:
+            cursor.execute("SELECT COUNT(*) FROM comparison_rows WHERE comparison_id = ? AND status = ?",
+                           (owner, status))
+        else:
+            cursor.execute("SELECT COUNT(*) FROM comparison_rows WHERE comparison_id = ?", (owner,))
+        return cursor.fetchone()[0]
+
+    @_pooled
+    def get_comparison_rows(self, comparison_id: int, status: Optional[str] = None,
+                            limit: Optional[int] = None, offset: int = 0,
+                            materialize: bool = True) -> List[Dict[str, Any]]:
+        """
+        Строки результата по требованиям в исходном порядке (с номером строки row_idx).
+        status — фильтр по статусу, limit/offset — постраничная выборка (limit=None — все).
+        materialize=False — без фрагментов КД и различий: для строк с отрезком
+        kd_evidence и diff равны None (см. get_comparison_row).
+        """
+        cursor = self._connect().cursor()
+        owner = self._rows_owner(cursor, comparison_id)
+
+        if materialize:
+            cols = ", ".join(self._row_select())
+        else:
+            cols = ", ".join(col for _, col in self.ROW_COLUMNS)
+        where = "comparison_id = ?"
+        params: List[Any] = [owner]
+        if status:
+            where += " AND status = ?"
+            params.append(status)
+        params += [-1 if limit is None else limit, offset]
+
+        cursor.execute(f'''
+                       SELECT row_idx, {cols} FROM comparison_rows
+                       WHERE {where}
+                       ORDER BY row_idx
+                       LIMIT ? OFFSET ?
+                       ''', params)
+
+        keys = ["row_idx"] + [key for key, _ in self.ROW_COLUMNS]
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    @_pooled
+    def get_comparison_row(self, comparison_id: int, row_idx: int) -> Optional[Dict[str, Any]]:
+        """Одна строка результата с фрагментом КД и различиями"""
+        cursor = self._connect().cursor()
+        owner = self._rows_owner(cursor, comparison_id)
+
+        cursor.execute(f'''
+                       SELECT row_idx, {", ".join(self._row_select())} FROM comparison_rows
+                       WHERE comparison_id = ? AND row_idx = ?
+                       ''', (owner, row_idx))
+
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(["row_idx"] + [key for key, _ in self.ROW_COLUMNS], row))
+
+    def save_profile(self, comparison_id: int, profile: Dict[str, Any]):
+        """Сохраняет Profiler.summary() для сравнения"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+
+            records = [
+                (comparison_id, s["stage"], s["calls"], s["items"], s["seconds"], None, None, None, None)
+                for s in profile.get("stages", [])
+            ]
+            for name, d in profile.get("distributions", {}).items():
+                records.append((
+                    comparison_id, f"{name} (на требование)", d["count"], d["count"], d["seconds"],
+                    d["p50"], d["p95"], d["max"], json.dumps(d["slowest"], ensure_ascii=False)
+                ))
+
+            cursor.executemany('''
+                               INSERT OR REPLACE INTO comparison_profile
+                               (comparison_id, stage, calls, items, seconds, p50, p95, max_seconds, slowest_json)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                               ''', records)
+
+    @_pooled
+    def get_profile(self, comparison_id: int) -> List[Dict[str, Any]]:
+        """Профиль выполнения сравнения (пустой список, если не записывался)"""
+        cursor = self._connect().cursor()
+
+        cursor.execute('''
+                       SELECT stage, calls, items, seconds, p50, p95, max_seconds, slowest_json
+                       FROM comparison_profile
+                       WHERE comparison_id = ?
+                       ORDER BY rowid
+                       ''', (comparison_id,))
+
+        rows = cursor.fetchall()
+
+        return [
+            {
+                'stage': row[0],
+                'calls': row[1],
+                'items': row[2],
+                'seconds': row[3],
+                'p50': row[4],
+                'p95': row[5],
+                'max': row[6],
+                'slowest': json.loads(row[7]) if row[7] else []
+            }
+            for row in rows
+        ]
+
     def add_comment(self, comparison_id: int, user_name: str, comment_text: str):
         """Добавляет комментарий к сравнению"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('''
-                       INSERT INTO comments (comparison_id, timestamp, user_name, comment_text)
-                       VALUES (?, ?, ?, ?)
-                       ''', (
-                           comparison_id,
-                           datetime.now().isoformat(),
-                           user_name,
-                           comment_text
-                       ))
-
-        conn.commit()
-        conn.close()
+            cursor.execute('''
+                           INSERT INTO comments (comparison_id, timestamp, user_name, comment_text)
+                           VALUES (?, ?, ?, ?)
+                           ''', (
+                               comparison_id,
+                               datetime.now().isoformat(),
+                               user_name,
+                               comment_text
+                           ))
 
+    @_pooled
     def get_comments(self, comparison_id: int) -> List[Dict[str, Any]]:
         """Получает все комментарии для сравнения"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._connect().cursor()
 
         cursor.execute('''
                        SELECT id, timestamp, user_name, comment_text
@@ -185,7 +1071,6 @@ class HistoryDatabase:
                        ''', (comparison_id,))
 
         rows = cursor.fetchall()
-        conn.close()
 
         comments = []
         for row in rows:
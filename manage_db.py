@@ -1,44 +1,301 @@
 # manage_db.py
-import sqlite3
 import argparse
+import csv
+import json
+import os
+from contextlib import closing
+from datetime import date, datetime, timedelta
 from database import HistoryDatabase
 
-def clean_old_records(days=30):
-    """Удаляет записи старше указанного количества дней"""
-    db = HistoryDatabase()
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
+# Сравнения старше cutoff и незавершённые ('running') старше stale_cutoff — независимо от --clean N;
+# исходные сравнения, на которые ссылаются оставшиеся повторные запуски, сохраняются.
+# 'deleting' — отмеченные прошлой (возможно, прерванной) очисткой
+EXPIRED_WHERE = '''
+    ((timestamp < :cutoff OR (state = 'running' AND timestamp < :stale_cutoff))
+     AND id NOT IN (SELECT reused_from FROM comparisons
+                    WHERE reused_from IS NOT NULL AND timestamp >= :cutoff))
+    OR state = 'deleting'
+'''
 
-    from datetime import datetime, timedelta
-    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+# Незавершённое сравнение старше этого считается брошенным (упавший запуск), а не идущим сейчас
+STALE_RUNNING = timedelta(hours=24)
 
-    cursor.execute("DELETE FROM comparisons WHERE timestamp < ?", (cutoff,))
-    deleted = cursor.rowcount
-    conn.commit()
-    conn.close()
+# Зависимые таблицы: без PRAGMA foreign_keys старые версии оставляли в них сироты
+DEPENDENT_TABLES = ("comparison_rows", "comparison_profile", "comments")
 
-    print(f"Удалено {deleted} записей старше {days} дней")
+# Тексты КД, на которые не ссылается ни одна строка результата
+UNUSED_DOCUMENTS_WHERE = "NOT EXISTS (SELECT 1 FROM comparison_rows r WHERE r.kd_doc = documents.id)"
 
-def export_to_excel():
-    """Экспортирует всю историю в Excel"""
-    db = HistoryDatabase()
-    comparisons = db.get_all_comparisons()
+def _delete_in_batches(db, select_sql, delete_sql, params, batch_size, label, total):
+    """Удаляет пачками по batch_size id: каждая пачка — короткая отдельная транзакция"""
+    done = 0
+    conn = db._connect()
+    while True:
+        ids = [r[0] for r in conn.execute(select_sql + " LIMIT :limit", {**params, "limit": batch_size})]
+        if not ids:
+            return done
+        marks = ", ".join("?" for _ in ids)
+        with db.transaction() as tx:
+            tx.execute(delete_sql.format(marks=marks), ids)
+        done += len(ids)
+        print(f"  {label}: {done}/{total}")
 
-    import pandas as pd
-    df = pd.DataFrame(comparisons)
-    df.to_excel("history_export.xlsx", index=False)
-    print("Экспорт завершен: history_export.xlsx")
+def _reclaim_space(db, pages_per_step=2000):
+    """
+    Возвращает свободные страницы ОС через incremental_vacuum небольшими шагами.
+    Старую БД (без auto_vacuum=INCREMENTAL) не трогает: её переводит только --convert-vacuum.
+    """
+    conn = db._connect()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # полный VACUUM держит эксклюзивную блокировку на всё время — внутри очистки не запускаем
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        print(f"БД не в режиме auto_vacuum=INCREMENTAL: {free} свободных страниц будут переиспользованы, "
+              "но не вернутся ОС. Нужен однократный офлайн-VACUUM: остановите приложение и выполните "
+              "python manage_db.py --convert-vacuum")
+    else:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free:
+            # прагма освобождает по странице на шаг выполнения, а execute() делает один шаг;
+            # executescript прогоняет оператор до конца
+            conn.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            print(f"  incremental_vacuum: свободных страниц осталось {free}")
+    # WAL тоже усекаем, иначе место займёт он
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def convert_vacuum():
+    """
+    Однократно переводит старую БД в auto_vacuum=INCREMENTAL (после этого --clean возвращает
+    место шагами). Это полный VACUUM под эксклюзивной блокировкой — запускать при остановленном приложении.
+    """
+    with closing(HistoryDatabase()) as db, db.connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            print("БД уже в режиме auto_vacuum=INCREMENTAL")
+            return
+        print("Перевожу БД в auto_vacuum=INCREMENTAL (полный VACUUM, может занять время)...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print("Готово")
+
+def clean_old_records(days=30, batch_size=100, dry_run=False, row_batch_size=5000):
+    """
+    Удаляет сравнения старше указанного количества дней и брошенные незавершённые
+    (state = 'running' дольше STALE_RUNNING) вместе со строками результата,
+    профилем и комментариями, и ставшие ненужными тексты КД; затем возвращает место на диске.
+    Сравнения удаляются пачками по batch_size, строки результата — отдельно, пачками
+    по row_batch_size: в одном сравнении их могут быть тысячи.
+    """
+    with closing(HistoryDatabase()) as db, db.connection() as conn:
+        now = datetime.now()
+        params = {
+            "cutoff": (now - timedelta(days=days)).isoformat(),
+            "stale_cutoff": (now - STALE_RUNNING).isoformat(),
+        }
+
+        total = conn.execute(f"SELECT COUNT(*) FROM comparisons WHERE {EXPIRED_WHERE}", params).fetchone()[0]
+        orphans = {
+            t: conn.execute(
+                f"SELECT COUNT(*) FROM {t} WHERE comparison_id NOT IN (SELECT id FROM comparisons)"
+            ).fetchone()[0]
+            for t in DEPENDENT_TABLES
+        }
+
+        if dry_run:
+            stale = conn.execute(
+                "SELECT COUNT(*) FROM comparisons WHERE state = 'running' AND timestamp < :stale_cutoff", params
+            ).fetchone()[0]
+            print(f"Будет удалено сравнений старше {days} дней и брошенных незавершённых: {total}"
+                  f" (незавершённых: {stale})")
+            for t in DEPENDENT_TABLES:
+                n = conn.execute(
+                    f"SELECT COUNT(*) FROM {t} WHERE comparison_id IN "
+                    f"(SELECT id FROM comparisons WHERE {EXPIRED_WHERE})", params
+                ).fetchone()[0]
+                print(f"  {t}: {n} (+ {orphans[t]} без сравнения)")
+            unused = conn.execute(f"SELECT COUNT(*) FROM documents WHERE {UNUSED_DOCUMENTS_WHERE}").fetchone()[0]
+            print(f"  documents без ссылок сейчас: {unused} (+ тексты КД только удаляемых сравнений)")
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            print(f"Свободно в файле уже сейчас: {free * page_size / 1024 / 1024:.1f} МБ")
+            return
+
+        print(f"Удаляю сравнения старше {days} дней и брошенные незавершённые: {total}")
+        # сначала отмечаем: отмеченные пропадают из истории, поиска и повторного использования
+        # (там только state = 'done'), пока их строки удаляются по частям
+        while True:
+            with db.transaction() as tx:
+                marked = tx.execute(
+                    f"UPDATE comparisons SET state = 'deleting' WHERE id IN "
+                    f"(SELECT id FROM comparisons WHERE ({EXPIRED_WHERE}) AND state != 'deleting' LIMIT :limit)",
+                    {**params, "limit": batch_size}
+                ).rowcount
+            if not marked:
+                break
+
+        # строки результата — пачками по числу строк, а не сравнений (каскад и триггер поиска — на каждую строку)
+        rows_total = conn.execute(
+            "SELECT COUNT(*) FROM comparison_rows WHERE comparison_id IN "
+            "(SELECT id FROM comparisons WHERE state = 'deleting')"
+        ).fetchone()[0]
+        if rows_total:
+            _delete_in_batches(
+                db,
+                "SELECT id FROM comparison_rows WHERE comparison_id IN "
+                "(SELECT id FROM comparisons WHERE state = 'deleting')",
+                "DELETE FROM comparison_rows WHERE id IN ({marks})",
+                {}, row_batch_size, "строки результата", rows_total
+            )
+
+        deleted = _delete_in_batches(
+            db,
+            "SELECT id FROM comparisons WHERE state = 'deleting'",
+            "DELETE FROM comparisons WHERE id IN ({marks})",
+            {}, batch_size, "сравнения", total
+        )
+
+        for t in DEPENDENT_TABLES:
+            if orphans[t]:
+                _delete_in_batches(
+                    db,
+                    f"SELECT rowid FROM {t} WHERE comparison_id NOT IN (SELECT id FROM comparisons)",
+                    f"DELETE FROM {t} WHERE rowid IN ({{marks}})",
+                    {}, row_batch_size, f"{t} без сравнения", orphans[t]
+                )
+
+        unused = conn.execute(f"SELECT COUNT(*) FROM documents WHERE {UNUSED_DOCUMENTS_WHERE}").fetchone()[0]
+        if unused:
+            _delete_in_batches(
+                db,
+                f"SELECT id FROM documents WHERE {UNUSED_DOCUMENTS_WHERE}",
+                "DELETE FROM documents WHERE id IN ({marks})",
+                {}, batch_size, "тексты КД", unused
+            )
+
+        _reclaim_space(db)
+        print(f"Удалено {deleted} записей (старше {days} дней и брошенных незавершённых)")
+
+EXPORT_FORMATS = ("xlsx", "csv", "jsonl")
+
+# Лимиты листа Excel: строк на лист и символов в ячейке
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_CELL = 32767
+
+def _write_csv(path, chunks):
+    n = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = None
+        for chunk in chunks:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(chunk[0]))
+                writer.writeheader()
+            writer.writerows(chunk)
+            n += len(chunk)
+            print(f"  записано {n}")
+    return n
+
+def _write_jsonl(path, chunks):
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in chunk)
+            n += len(chunk)
+            print(f"  записано {n}")
+    return n
+
+def _write_xlsx(path, chunks):
+    # write_only: строки уходят во временный файл, а не держатся в памяти
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    def cell(v):
+        if isinstance(v, str):
+            return ILLEGAL_CHARACTERS_RE.sub("", v)[:XLSX_MAX_CELL]
+        return v
+
+    wb = Workbook(write_only=True)
+    ws = None
+    header = None
+    rows_in_sheet = 0
+    n = 0
+    for chunk in chunks:
+        if header is None:
+            header = list(chunk[0])
+        for r in chunk:
+            if ws is None or rows_in_sheet >= XLSX_MAX_ROWS:
+                ws = wb.create_sheet(f"history_{len(wb.worksheets) + 1}")
+                ws.append(header)
+                rows_in_sheet = 1
+            ws.append([cell(v) for v in r.values()])
+            rows_in_sheet += 1
+        n += len(chunk)
+        print(f"  записано {n}")
+    if ws is None:
+        wb.create_sheet("history_1")
+    wb.save(path)
+    return n
+
+def export_history(path="history_export.xlsx", fmt=None, include_rows=False,
+                   date_from=None, date_to=None, ids=None, chunk_size=1000):
+    """
+    Потоковый экспорт истории в XLSX/CSV/JSONL (формат по расширению, если не задан).
+    include_rows — с результатами по каждому требованию; date_to включительно.
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат экспорта: {fmt} (доступны: {', '.join(EXPORT_FORMATS)})")
+
+    writer = {"xlsx": _write_xlsx, "csv": _write_csv, "jsonl": _write_jsonl}[fmt]
+    with closing(HistoryDatabase()) as db:
+        chunks = db.iter_export(
+            include_rows=include_rows,
+            chunk_size=chunk_size,
+            ids=ids,
+            date_from=date_from.isoformat() if date_from else None,
+            date_to=(date_to + timedelta(days=1)).isoformat() if date_to else None,
+        )
+        n = writer(path, chunks)
+    print(f"Экспорт завершен: {path} ({n} записей)")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--clean", type=int, help="Очистить записи старше N дней")
-    parser.add_argument("--export", action="store_true", help="Экспорт в Excel")
+    parser.add_argument("--batch-size", type=int, default=100, help="Сравнений на одну транзакцию удаления")
+    parser.add_argument("--row-batch-size", type=int, default=5000,
+                        help="Строк результата на одну транзакцию удаления")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет удалено")
+    parser.add_argument("--export", nargs="?", const="history_export.xlsx", metavar="PATH",
+                        help="Экспорт истории (по умолчанию history_export.xlsx)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="Формат экспорта (по умолчанию — по расширению)")
+    parser.add_argument("--include-rows", action="store_true", help="Включить результаты по каждому требованию")
+    parser.add_argument("--date-from", type=date.fromisoformat, help="Экспорт: с даты (ГГГГ-ММ-ДД)")
+    parser.add_argument("--date-to", type=date.fromisoformat, help="Экспорт: по дату включительно (ГГГГ-ММ-ДД)")
+    parser.add_argument("--ids", type=lambda s: [int(x) for x in s.split(",")], help="Экспорт: ID сравнений через запятую")
+    parser.add_argument("--rebuild-search", action="store_true", help="Перестроить полнотекстовый индекс истории")
+    parser.add_argument("--convert-vacuum", action="store_true",
+                        help="Однократно перевести старую БД в auto_vacuum=INCREMENTAL (полный VACUUM, офлайн)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Записей на одну выборку при экспорте")
 
     args = parser.parse_args()
 
-    if args.clean:
-        clean_old_records(args.clean)
+    if args.clean is not None:
+        clean_old_records(args.clean, batch_size=max(1, args.batch_size), dry_run=args.dry_run,
+                          row_batch_size=max(1, args.row_batch_size))
     elif args.export:
-        export_to_excel()
+        export_history(
+            args.export,
+            fmt=args.format,
+            include_rows=args.include_rows,
+            date_from=args.date_from,
+            date_to=args.date_to,
+            ids=args.ids,
+            chunk_size=max(1, args.chunk_size),
+        )
+    elif args.convert_vacuum:
+        convert_vacuum()
+    elif args.rebuild_search:
+        with closing(HistoryDatabase()) as db:
+            n = db.rebuild_search_index()
+        print(f"Полнотекстовый индекс перестроен: {n} строк")
     else:
         print("Использование: python manage_db.py --clean 30 или --export")
\ No newline at end of file
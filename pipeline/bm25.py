@@ -0,0 +1,129 @@
+"""
+Векторный BM25-скоринг требований ТТЗ по блокам КД.
+
+Все блоки КД собираются в разреженную матрицу термин x блок, все требования —
+в бинарную матрицу требование x термин, и скоры считаются пачкой через
+матричное произведение (scipy.sparse, если установлен, иначе posting-листы на NumPy).
+Для каждого требования возвращаются top-k блоков, которые затем
+переранжируются обычной эвристикой score_block.
+"""
+from collections import Counter
+from typing import Dict, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy приходит вместе с pandas
+    np = None
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+from pipeline.match_kd import KDIndex, _tokenize_normalized, tokenize
+from pipeline.profiling import timed
+
+SCORE_MODES = ("auto", "heuristic", "bm25")
+
+# С какого числа блоков КД режим "auto" переключается на BM25
+BM25_MIN_BLOCKS = 500
+# Сколько лучших блоков BM25 отдаёт на переранжирование эвристикой
+BM25_TOP_K = 20
+
+def resolve_score_mode(score_mode: str, kd_index: KDIndex) -> str:
+    if score_mode not in SCORE_MODES:
+        raise ValueError(f"Неизвестный режим скоринга: {score_mode}")
+    if score_mode == "bm25" and np is None:
+        raise ImportError("Для режима bm25 нужен numpy")
+    if score_mode == "auto":
+        if np is not None and len(kd_index.blocks) >= BM25_MIN_BLOCKS:
+            return "bm25"
+        return "heuristic"
+    return score_mode
+
+class BM25Scorer:
+    @timed("bm25_index")
+    def __init__(self, kd_index: KDIndex, k1: float = 1.5, b: float = 0.75):
+        if np is None:
+            raise ImportError("Для BM25Scorer нужен numpy")
+
+        self.n_blocks = len(kd_index.blocks)
+        self.vocab: Dict[str, int] = {}
+
+        rows: List[int] = []
+        cols: List[int] = []
+        tfs: List[int] = []
+        doc_len = np.zeros(self.n_blocks, dtype=np.float64)
+        for i, bn in enumerate(kd_index.block_norm):
+            counts = Counter(_tokenize_normalized(bn))
+            doc_len[i] = sum(counts.values())
+            for t, c in counts.items():
+                rows.append(i)
+                cols.append(self.vocab.setdefault(t, len(self.vocab)))
+                tfs.append(c)
+
+        block_ids = np.asarray(rows, dtype=np.int64)
+        term_ids = np.asarray(cols, dtype=np.int64)
+        tf = np.asarray(tfs, dtype=np.float64)
+
+        n_terms = len(self.vocab)
+        df = np.bincount(term_ids, minlength=n_terms).astype(np.float64)
+        idf = np.log1p((self.n_blocks - df + 0.5) / (df + 0.5))
+        avgdl = float(doc_len.mean()) if self.n_blocks and doc_len.mean() > 0 else 1.0
+        norm = k1 * (1.0 - b + b * doc_len[block_ids] / avgdl)
+        weights = idf[term_ids] * tf * (k1 + 1.0) / (tf + norm)
+
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix((weights, (term_ids, block_ids)), shape=(n_terms, self.n_blocks))
+        else:
+            # CSR по терминам: posting-лист термина j лежит в [indptr[j], indptr[j+1])
+            order = np.argsort(term_ids, kind="stable")
+            self.post_blocks = block_ids[order]
+            self.post_weights = weights[order]
+            self.indptr = np.zeros(n_terms + 1, dtype=np.int64)
+            np.cumsum(df.astype(np.int64), out=self.indptr[1:])
+
+    def _term_ids(self, text: str) -> List[int]:
+        return sorted({self.vocab[t] for t in tokenize(text) if t in self.vocab})
+
+    def _top(self, scores, k: int) -> "np.ndarray":
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[scores[idx] > 0]
+        # по убыванию скора, при равенстве — в порядке КД
+        return idx[np.lexsort((idx, -scores[idx]))]
+
+    @timed("bm25_top_k", items=len)
+    def top_k(self, texts: Sequence[str], k: int = BM25_TOP_K, chunk_size: int = 256) -> List["np.ndarray"]:
+        """Для каждого текста — номера до k лучших блоков КД (только с ненулевым скором)."""
+        out: List[np.ndarray] = []
+        if sparse is not None:
+            for a in range(0, len(texts), chunk_size):
+                chunk = texts[a:a + chunk_size]
+                r_idx: List[int] = []
+                t_idx: List[int] = []
+                for r, text in enumerate(chunk):
+                    ids = self._term_ids(text)
+                    r_idx.extend([r] * len(ids))
+                    t_idx.extend(ids)
+                q = sparse.csr_matrix(
+                    (np.ones(len(t_idx)), (r_idx, t_idx)),
+                    shape=(len(chunk), len(self.vocab)),
+                )
+                scores = (q @ self.matrix).toarray()
+                out.extend(self._top(row, k) for row in scores)
+            return out
+
+        for text in texts:
+            ids = self._term_ids(text)
+            if not ids:
+                out.append(np.zeros(0, dtype=np.int64))
+                continue
+            sl = [slice(self.indptr[j], self.indptr[j + 1]) for j in ids]
+            blocks = np.concatenate([self.post_blocks[s] for s in sl])
+            weights = np.concatenate([self.post_weights[s] for s in sl])
+            scores = np.bincount(blocks, weights=weights, minlength=self.n_blocks)
+            out.append(self._top(scores, k))
+        return out
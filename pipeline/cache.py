@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+from pipeline.extract_text import EXTRACTOR_VERSION, Source, extract_text
+from pipeline.ocr import engine_name
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 файла, читаемого кусками (совпадает с content_hash его содержимого)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ExtractCache:
+    """
+    Дисковый кэш извлечённого текста.
+    Ключ — sha256 содержимого файла + расширение + EXTRACTOR_VERSION,
+    значение — сжатый zlib текст и meta. При превышении max_bytes
+    вытесняются давно не читанные записи (LRU).
+    """
+
+    def __init__(self, db_path: str = "extract_cache.db", max_bytes: int = 512 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.init_database()
+
+    def init_database(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+                       CREATE TABLE IF NOT EXISTS extract_cache (
+                           key TEXT PRIMARY KEY,
+                           text_z BLOB NOT NULL,
+                           meta_json TEXT NOT NULL,
+                           size INTEGER NOT NULL,
+                           last_access REAL NOT NULL
+                       )
+                       ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_extract_cache_access ON extract_cache (last_access)")
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def make_key(file_hash: str, filename: str, ocr: Optional[str] = None) -> str:
+        ext = os.path.splitext(filename.lower().strip())[1]
+        key = f"{file_hash}:{ext}:{EXTRACTOR_VERSION}"
+        # текст с OCR и без него — разные записи
+        return f"{key}:ocr={ocr}" if ocr else key
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT text_z, meta_json FROM extract_cache WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE extract_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        conn.close()
+
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not row:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8"), json.loads(row[1])
+
+    def put(self, key: str, text: str, meta: Dict[str, Any]):
+        text_z = zlib.compress(text.encode("utf-8"), 6)
+        if len(text_z) > self.max_bytes:
+            return
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+                       INSERT OR REPLACE INTO extract_cache (key, text_z, meta_json, size, last_access)
+                       VALUES (?, ?, ?, ?, ?)
+                       ''', (key, text_z, json.dumps(meta, ensure_ascii=False), len(text_z), time.time()))
+
+        # LRU-вытеснение до укладывания в бюджет
+        cursor.execute("SELECT COALESCE(SUM(size), 0) FROM extract_cache")
+        total = cursor.fetchone()[0]
+        if total > self.max_bytes:
+            cursor.execute("SELECT key, size FROM extract_cache ORDER BY last_access ASC")
+            evict = []
+            for k, size in cursor.fetchall():
+                if total <= self.max_bytes:
+                    break
+                if k == key:
+                    continue
+                evict.append((k,))
+                total -= size
+            cursor.executemany("DELETE FROM extract_cache WHERE key = ?", evict)
+
+        conn.commit()
+        conn.close()
+
+    def extract(self, file_bytes: Source, filename: str, file_hash: Optional[str] = None,
+                **kwargs) -> Tuple[str, Dict[str, Any]]:
+        """
+        То же, что extract_text, но повторная загрузка того же файла не трогает PyMuPDF/python-docx.
+        file_bytes — содержимое или путь к файлу (тогда хэш считается потоково).
+        """
+        if file_hash is None:
+            is_path = isinstance(file_bytes, (str, os.PathLike))
+            file_hash = hash_file(file_bytes) if is_path else content_hash(file_bytes)
+        key = self.make_key(file_hash, filename, engine_name(kwargs.get("ocr")))
+        cached = self.get(key)
+        if cached is not None:
+            text, meta = cached
+            meta["cache"] = "hit"
+            return text, meta
+
+        text, meta = extract_text(file_bytes, filename, **kwargs)
+        if meta.get("ocr_skipped") or meta.get("ocr_errors"):
+            # OCR не уложился в бюджет или упал на части страниц — следующая попытка может дать больше
+            meta["cache"] = "partial"
+            return text, meta
+        self.put(key, text, meta)
+        meta["cache"] = "miss"
+        return text, meta
+
+    def stats(self) -> Dict[str, Any]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extract_cache")
+        entries, size = cursor.fetchone()
+        conn.close()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
@@ -1,68 +1,67 @@
-import difflib
-import re
-from typing import Any, Dict, List, Tuple
+import time
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from pipeline.match_kd import find_best_block, normalize_text
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy приходит вместе с pandas
+    np = None
 
-NUM_UNIT_RE = re.compile(
-    r"(?i)(\d+(?:[.,]\d+)?)\s*(лм|в|вт|кг|г|мм|см|м|а|ма|ач|мбит/с|бит/с|гб|%|℃|°c|град/сек|мгц|дбмвт|ip\d{2})"
-)
+from pipeline.bm25 import BM25Scorer, resolve_score_mode
+from pipeline.constraints import ANY_UNIT, UNIT_FAMILIES, Constraint, family_units, kd_facts
+from pipeline.extract_text import EXTRACTOR_VERSION
+from pipeline.match_kd import KDIndex, diff_summary, find_best_block, normalize_text
+from pipeline.ocr import DEFAULT_ENGINE as OCR_ENGINE
+from pipeline.parse_ttz import RequirementTable
+from pipeline.profiling import observe, stage
 
-MIN_RE = re.compile(r"(?i)\b(?:не\s+менее|не\s+ниже|минимум)\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
-MAX_RE = re.compile(r"(?i)\b(?:не\s+более|не\s+выше|максимум)\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
-RANGE_RE = re.compile(r"(?i)\bот\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?\s+до\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
+# Повышать при любом изменении разбора ТТЗ / сопоставления, влияющем на результат.
+# Сохранённые в истории результаты с другой версией не переиспользуются.
+COMPARE_VERSION = "3"
+PIPELINE_VERSION = f"extract-{EXTRACTOR_VERSION}/compare-{COMPARE_VERSION}"
+# с OCR тексты сканов другие — сравнения без OCR (и с другим движком) не переиспользуются
+if OCR_ENGINE:
+    PIPELINE_VERSION += f"/ocr-{OCR_ENGINE}"
 
-def _to_float(x: str) -> float:
-    return float(x.replace(",", "."))
+def pipeline_version(scale_units: bool = False) -> str:
+    """Версия для ключа переиспользования: с пересчётом единиц вердикты другие"""
+    return PIPELINE_VERSION + ("/scale-units" if scale_units else "")
 
-def _norm_unit(u: str) -> str:
-    return (u or "").strip().lower().replace("°c", "℃")
+def extract_kd_values(snippet: str) -> List[Tuple[float, str]]:
+    return list(kd_facts(snippet)[0])
 
-def diff_summary(a: str, b: str, max_lines: int = 8) -> str:
-    a_lines = [a.strip()]
-    b_lines = [b.strip()]
-    d = list(difflib.unified_diff(a_lines, b_lines, lineterm=""))
-    out = [line for line in d if line.startswith(("+", "-", "@@"))][:max_lines]
-    return "\n".join(out).strip()
+def extract_kd_constraints(snippet: str) -> List[Constraint]:
+    return list(kd_facts(snippet)[1])
 
-def extract_kd_values(snippet: str) -> List[Tuple[float, str]]:
-    vals: List[Tuple[float, str]] = []
-    for n, u in NUM_UNIT_RE.findall(snippet):
-        vals.append((_to_float(n), _norm_unit(u)))
-    return vals
-
-def extract_kd_constraints(snippet: str) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
-    for m in RANGE_RE.finditer(snippet):
-        a, u1, b, u2 = m.group(1), m.group(2), m.group(3), m.group(4)
-        unit = _norm_unit(u1 or u2 or "")
-        out.append({"op": "range", "min": _to_float(a), "max": _to_float(b), "unit": unit})
-    for m in MIN_RE.finditer(snippet):
-        v, u = m.group(1), m.group(2)
-        out.append({"op": ">=", "value": _to_float(v), "unit": _norm_unit(u or "")})
-    for m in MAX_RE.finditer(snippet):
-        v, u = m.group(1), m.group(2)
-        out.append({"op": "<=", "value": _to_float(v), "unit": _norm_unit(u or "")})
-    return out
-
-def eval_constraints(req_constraints: List[Dict[str, Any]], snippet: str) -> Tuple[int, int, str]:
+def eval_constraints(
+        req_constraints: Sequence[Constraint],
+        snippet: str,
+        kd_index: Optional[KDIndex] = None,
+        span: Optional[Tuple[int, int]] = None,
+) -> Tuple[int, int, str]:
     """
     Возвращает:
       (satisfied, total, note)
     total — число "проверяемых" ограничений (>=, <=, range). raw не считаем строгим.
+    Если переданы kd_index и span фрагмента (из find_best_block), значения берутся
+    из индекса чисел КД, а не разбором текста фрагмента.
     """
-    strict = [c for c in req_constraints if c.get("op") in (">=", "<=", "range")]
+    strict = [c for c in req_constraints if c.op in (">=", "<=", "range")]
     if not strict:
         return 0, 0, ""
 
-    kd_vals = extract_kd_values(snippet)
-    kd_cons = extract_kd_constraints(snippet)
+    # факты фрагмента КД извлекаются один раз на фрагмент (мемоизация в kd_facts)
+    kd_vals, kd_cons = kd_facts(snippet)
 
     satisfied = 0
     total = len(strict)
     notes: List[str] = []
 
     def best_val_for_unit(unit: str) -> Tuple[bool, float]:
+        if kd_index is not None and span is not None:
+            # первое по тексту значение в этой единице (без единицы — любое, очень грубо)
+            v = kd_index.numbers.first_in_span(unit or ANY_UNIT, *span)
+            return (v is not None, v if v is not None else 0.0)
         if not unit:
             # если единицы не указаны, берём любое число (очень грубо)
             return (len(kd_vals) > 0, kd_vals[0][0] if kd_vals else 0.0)
@@ -72,23 +71,23 @@ def eval_constraints(req_constraints: List[Dict[str, Any]], snippet: str) -> Tup
         return (False, 0.0)
 
     for c in strict:
-        op = c["op"]
-        unit = _norm_unit(c.get("unit", ""))
+        op = c.op
+        unit = c.unit
         ok = None
 
         # Если в КД прямо повторено ограничение (в kd_cons) — это сильный сигнал
         for kc in kd_cons:
-            if _norm_unit(kc.get("unit","")) != unit:
+            if kc.unit != unit:
                 continue
-            if op == kc["op"]:
+            if op == kc.op:
                 if op == "range":
-                    ok = (kc["min"] <= c["min"] and kc["max"] >= c["max"]) or (c["min"] <= kc["min"] <= kc["max"] <= c["max"])
+                    ok = (kc.min <= c.min and kc.max >= c.max) or (c.min <= kc.min <= kc.max <= c.max)
                 else:
                     # если в КД написано "не менее X" — удовлетворяет, если X >= требуемого
                     if op == ">=":
-                        ok = kc["value"] >= c["value"]
+                        ok = kc.value >= c.value
                     elif op == "<=":
-                        ok = kc["value"] <= c["value"]
+                        ok = kc.value <= c.value
                 if ok is True:
                     break
 
@@ -98,72 +97,363 @@ def eval_constraints(req_constraints: List[Dict[str, Any]], snippet: str) -> Tup
                 notes.append(f"нет значения для единицы '{unit}'")
                 continue
             if op == ">=":
-                ok = v >= c["value"]
+                ok = v >= c.value
             elif op == "<=":
-                ok = v <= c["value"]
+                ok = v <= c.value
             else:  # range
-                ok = (v >= c["min"] and v <= c["max"])
+                ok = (v >= c.min and v <= c.max)
 
         if ok:
             satisfied += 1
         else:
-            notes.append(f"числовое несоответствие ({op} {c.get('value', '') or (str(c.get('min'))+'..'+str(c.get('max')))} {unit})")
+            notes.append(_mismatch_note(c, unit))
 
     return satisfied, total, "; ".join(notes)
 
-def compare_requirements(requirements, kd_text: str) -> list[dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-
-    for req in requirements:
-        best = find_best_block(
-            kd_text=kd_text,
-            req_num=req.num,
-            req_text=req.text,
-            req_nums_units=req.nums_units
-        )
-
-        snippet = best["evidence"]
-        match_type = best["match_type"]
-
-        if not snippet:
-            rows.append({
-                "req_id": req.req_id,
-                "ttz_section": req.section,
-                "req_text": req.text,
-                "status": "NOT_FOUND",
-                "match_type": "",
-                "kd_evidence": "",
-                "numbers_covered": "",
-                "diff": "",
-            })
+_OP_CODES = {">=": 0, "<=": 1, "range": 2}
+
+def _mismatch_note(c: Constraint, unit: str) -> str:
+    return f"числовое несоответствие ({c.op} {c.value or (str(c.min)+'..'+str(c.max))} {unit})"
+
+def _first_value(unit: str, scale_units: bool, snippet: str,
+                 kd_index: Optional[KDIndex], span: Optional[Tuple[int, int]]) -> Optional[float]:
+    """Первое по тексту фрагмента значение в единице (с пересчётом — в любой единице семейства)"""
+    units = family_units(unit) if scale_units and unit else [(unit or ANY_UNIT, 1.0)]
+    hits: List[Tuple[int, float]] = []
+    if kd_index is not None and span is not None:
+        for u, k in units:
+            hit = kd_index.numbers.first_in_span_at(u, *span)
+            if hit:
+                hits.append((hit[0], hit[1] * k))
+    else:
+        scale = dict(units)
+        for pos, (v, u) in enumerate(kd_facts(snippet)[0]):
+            if u in scale or not unit:
+                hits.append((pos, v * scale.get(u, 1.0)))
+                break
+    return min(hits)[1] if hits else None
+
+def _object_constraints(requirements: Sequence, matches: Sequence[Dict[str, Any]],
+                        unit_key: Callable[[str], Tuple[str, float]], unit_ids: Dict[str, int]):
+    """Строгие ограничения требований-объектов с найденным фрагментом КД — в массивы"""
+    c_req: List[int] = []
+    c_op: List[int] = []
+    c_lo: List[float] = []
+    c_hi: List[float] = []
+    c_unit: List[int] = []
+    c_ref: List[Tuple[Constraint, str]] = []
+    for r, (req, m) in enumerate(zip(requirements, matches)):
+        if not m["evidence"]:
             continue
+        for c in req.constraints:
+            op = _OP_CODES.get(c.op)
+            if op is None:
+                continue
+            base, k = unit_key(c.unit)
+            c_req.append(r)
+            c_op.append(op)
+            if op == 2:
+                c_lo.append(c.min * k)
+                c_hi.append(c.max * k)
+            else:
+                c_lo.append(c.value * k)
+                c_hi.append(c.value * k)
+            c_unit.append(unit_ids.setdefault(base, len(unit_ids)))
+            c_ref.append((c, c.unit))
+    return (
+        np.asarray(c_req, dtype=np.int64),
+        np.asarray(c_op, dtype=np.int64),
+        np.asarray(c_lo, dtype=np.float64),
+        np.asarray(c_hi, dtype=np.float64),
+        np.asarray(c_unit, dtype=np.int64),
+        c_ref.__getitem__,
+    )
 
-        # Инженерная проверка чисел (>=, <=, диапазон)
-        sat, tot, note = eval_constraints(getattr(req, "constraints", []), snippet)
+def _table_constraints(table: RequirementTable, matches: Sequence[Dict[str, Any]],
+                       unit_key: Callable[[str], Tuple[str, float]], unit_ids: Dict[str, int]):
+    """То же для RequirementTable — прямо из плоских массивов, без объектов Requirement"""
+    offsets = np.frombuffer(table.c_offsets, dtype=np.int64)
+    owner = np.repeat(np.arange(len(table), dtype=np.int64), np.diff(offsets))
+    ops = np.frombuffer(table.c_ops, dtype=np.int8).astype(np.int64)
+    has_evidence = np.array([bool(m["evidence"]) for m in matches], dtype=bool)
+    # коды операций таблицы совпадают с _OP_CODES для строгих, 3 — raw
+    sel = np.flatnonzero((ops < 3) & has_evidence[owner])
 
-        if tot == 0:
-            # нет строгих ограничений — просто FOUND, но тип покажем
-            status = "FOUND"
-            numbers = ""
-        else:
-            numbers = f"{sat}/{tot}"
-            if sat == tot:
-                status = "OK"
+    # код единицы таблицы -> id базовой единицы и множитель
+    codes = np.frombuffer(table.c_units, dtype=np.int32)[sel]
+    used = np.unique(codes)
+    unit_of = np.zeros(len(table.units), dtype=np.int64)
+    scale_of = np.ones(len(table.units), dtype=np.float64)
+    for code in used.tolist():
+        base, k = unit_key(table.units[code])
+        unit_of[code] = unit_ids.setdefault(base, len(unit_ids))
+        scale_of[code] = k
+
+    op = ops[sel]
+    k = scale_of[codes]
+    is_range = op == 2
+    values = np.frombuffer(table.c_values, dtype=np.float64)[sel]
+    lo = np.where(is_range, np.frombuffer(table.c_mins, dtype=np.float64)[sel], values) * k
+    hi = np.where(is_range, np.frombuffer(table.c_maxs, dtype=np.float64)[sel], values) * k
+
+    def ref(i: int) -> Tuple[Constraint, str]:
+        c = table.constraint(int(sel[i]))
+        return c, c.unit
+
+    return owner[sel], op, lo, hi, unit_of[codes], ref
+
+def eval_constraints_batch(
+        requirements: Sequence,
+        matches: Sequence[Dict[str, Any]],
+        kd_index: Optional[KDIndex] = None,
+        scale_units: bool = False,
+) -> List[Tuple[int, int, str]]:
+    """
+    То же, что eval_constraints для каждой пары (требование, результат find_best_block),
+    но все строгие ограничения всех требований сравниваются разом массивами NumPy:
+    (код операции, min, max, единица, номер требования) против явных ограничений
+    и значений фрагментов КД. Результаты и тексты замечаний совпадают с eval_constraints.
+
+    scale_units — сравнивать внутри семейств единиц (мм/см/м, мА/А, ...) с пересчётом
+    к базовой единице; по умолчанию единицы должны совпадать, как в eval_constraints.
+    """
+    results: List[Tuple[int, int, str]] = [(0, 0, "")] * len(requirements)
+    if np is None:
+        for i, (req, m) in enumerate(zip(requirements, matches)):
+            if m["evidence"]:
+                results[i] = eval_constraints(req.constraints, m["evidence"], kd_index=kd_index, span=m.get("span"))
+        return results
+
+    def unit_key(unit: str) -> Tuple[str, float]:
+        return UNIT_FAMILIES.get(unit, (unit, 1.0)) if scale_units else (unit, 1.0)
+
+    unit_ids: Dict[str, int] = {}
+    # ограничения требований: номер требования, операция, границы, единица (id базовой)
+    # и функция, возвращающая само ограничение (для замечаний)
+    gather = _table_constraints if isinstance(requirements, RequirementTable) else _object_constraints
+    req, op, lo, hi, c_unit, c_ref = gather(requirements, matches, unit_key, unit_ids)
+    if not len(req):
+        return results
+    c_req = req.tolist()
+
+    # явные ограничения фрагментов КД тех же требований (с единицами, которые вообще встречаются)
+    k_req: List[int] = []
+    k_op: List[int] = []
+    k_lo: List[float] = []
+    k_hi: List[float] = []
+    k_unit: List[int] = []
+    for r in sorted(set(c_req)):
+        for kc in kd_facts(matches[r]["evidence"])[1]:
+            base, k = unit_key(kc.unit)
+            if base not in unit_ids:
+                continue
+            kop = _OP_CODES[kc.op]
+            k_req.append(r)
+            k_op.append(kop)
+            if kop == 2:
+                k_lo.append(kc.min * k)
+                k_hi.append(kc.max * k)
             else:
-                status = "PARTIAL"
+                k_lo.append(kc.value * k)
+                k_hi.append(kc.value * k)
+            k_unit.append(unit_ids[base])
+
+    n_units = len(unit_ids)
+    c_keys = (req * 3 + op) * n_units + c_unit
+
+    # пары (ограничение ТТЗ, ограничение КД) с той же операцией и единицей
+    k_keys = (np.asarray(k_req, dtype=np.int64) * 3 + np.asarray(k_op, dtype=np.int64)) * n_units \
+        + np.asarray(k_unit, dtype=np.int64)
+    order = np.argsort(k_keys, kind="stable")
+    k_keys = k_keys[order]
+    k_lo_arr = np.asarray(k_lo, dtype=np.float64)[order]
+    k_hi_arr = np.asarray(k_hi, dtype=np.float64)[order]
+    first = np.searchsorted(k_keys, c_keys, side="left")
+    counts = np.searchsorted(k_keys, c_keys, side="right") - first
+
+    pair_c = np.repeat(np.arange(len(c_keys)), counts)
+    pair_k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    pc_op, pc_lo, pc_hi = op[pair_c], lo[pair_c], hi[pair_c]
+    pk_lo, pk_hi = k_lo_arr[pair_k], k_hi_arr[pair_k]
+    pair_ok = np.where(
+        pc_op == 0, pk_lo >= pc_lo,
+        np.where(
+            pc_op == 1, pk_lo <= pc_lo,
+            ((pk_lo <= pc_lo) & (pk_hi >= pc_hi)) | ((pc_lo <= pk_lo) & (pk_lo <= pk_hi) & (pk_hi <= pc_hi)),
+        ),
+    )
+    has_kc = counts > 0
+    kc_ok = np.bincount(pair_c, weights=pair_ok, minlength=len(c_keys)) > 0
 
-        if note:
-            match_type = f"{match_type}; {note}"
+    # без явного ограничения в КД — первое значение фрагмента в той же единице
+    value = np.zeros(len(c_keys), dtype=np.float64)
+    has_value = np.zeros(len(c_keys), dtype=bool)
+    for i in np.flatnonzero(~has_kc):
+        r = c_req[i]
+        v = _first_value(c_ref(i)[1], scale_units, matches[r]["evidence"], kd_index, matches[r].get("span"))
+        if v is not None:
+            value[i] = v
+            has_value[i] = True
+    value_ok = np.where(op == 0, value >= lo, np.where(op == 1, value <= lo, (value >= lo) & (value <= hi)))
 
-        rows.append({
+    ok = np.where(has_kc, kc_ok, has_value & value_ok)
+    total = np.bincount(req, minlength=len(requirements))
+    satisfied = np.bincount(req, weights=ok, minlength=len(requirements))
+
+    notes: Dict[int, List[str]] = {}
+    for i in np.flatnonzero(~ok):
+        c, unit = c_ref(i)
+        if has_kc[i] or has_value[i]:
+            note = _mismatch_note(c, unit)
+        else:
+            note = f"нет значения для единицы '{unit}'"
+        notes.setdefault(c_req[i], []).append(note)
+
+    for r in set(c_req):
+        results[r] = (int(satisfied[r]), int(total[r]), "; ".join(notes.get(r, [])))
+    return results
+
+def _make_row(req, best: Dict[str, Any], sat: int, tot: int, note: str,
+              kd_doc: Optional[int] = None) -> Dict[str, Any]:
+    snippet = best["evidence"]
+    match_type = best["match_type"]
+
+    if not snippet:
+        return {
             "req_id": req.req_id,
             "ttz_section": req.section,
             "req_text": req.text,
-            "status": status,
-            "match_type": match_type,
-            "kd_evidence": snippet,
-            "numbers_covered": numbers,
-            "diff": diff_summary(req.text, snippet),
-        })
-
-    return rows
+            "status": "NOT_FOUND",
+            "match_type": "",
+            "kd_evidence": "",
+            "numbers_covered": "",
+            "diff": "",
+            "kd_doc": kd_doc,
+            "kd_start": None,
+            "kd_end": None,
+            "kd_cut": None,
+        }
+
+    # Инженерная проверка чисел (>=, <=, диапазон) — результат eval_constraints_batch
+    if tot == 0:
+        # нет строгих ограничений — просто FOUND, но тип покажем
+        status = "FOUND"
+        numbers = ""
+    else:
+        numbers = f"{sat}/{tot}"
+        if sat == tot:
+            status = "OK"
+        else:
+            status = "PARTIAL"
+
+    if note:
+        match_type = f"{match_type}; {note}"
+
+    start, end = best["span"]
+    lazy = kd_doc is not None
+    return {
+        "req_id": req.req_id,
+        "ttz_section": req.section,
+        "req_text": req.text,
+        "status": status,
+        "match_type": match_type,
+        # при сохранённом тексте КД фрагмент и различия восстанавливаются по отрезку, когда нужны
+        "kd_evidence": None if lazy else snippet,
+        "numbers_covered": numbers,
+        "diff": None if lazy else diff_summary(req.text, snippet),
+        "kd_doc": kd_doc,
+        "kd_start": start,
+        "kd_end": end,
+        "kd_cut": 1 if best.get("cut") else None,
+    }
+
+# Пачка требований без BM25: хватает, чтобы окупить массивы eval_constraints_batch
+HEURISTIC_CHUNK_SIZE = 8
+
+def _iter_chunks(requirements: Iterable, chunk_size: int) -> Iterator[Tuple[List, Sequence]]:
+    """Пачки требований: (объекты Requirement для сопоставления, пачка для eval_constraints_batch)"""
+    if isinstance(requirements, RequirementTable):
+        # ограничения пачки проверяются прямо по колонкам подтаблицы
+        for start in range(0, len(requirements), chunk_size):
+            batch = requirements.slice(start, start + chunk_size)
+            yield list(batch), batch
+        return
+    it = iter(requirements)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk, chunk
+
+def iter_compare_requirements(
+        requirements: Iterable,
+        kd_text: str,
+        kd_index: Optional[KDIndex] = None,
+        score_mode: str = "auto",
+        chunk_size: int = 256,
+        scale_units: bool = False,
+        kd_doc: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Отдаёт строки результата по одной, в порядке требований, по мере готовности.
+    requirements может быть любым итерируемым (в том числе генератором) или RequirementTable:
+    требования читаются пачками по chunk_size, чтобы BM25 скорил их матрично,
+    а числовые ограничения пачки проверялись разом (eval_constraints_batch).
+    Без BM25 пачка не больше HEURISTIC_CHUNK_SIZE: строки приходят ровно, без рывков прогресса.
+
+    score_mode:
+      "heuristic" — эвристика score_block по всем блокам с общими токенами или значениями;
+      "bm25"      — векторный BM25 отбирает top-k блоков, эвристика их переранжирует;
+      "auto"      — bm25 для больших КД (см. pipeline.bm25.BM25_MIN_BLOCKS).
+
+    Каждая строка несёт отрезок фрагмента kd_start/kd_end в kd_index.kd_text.
+    kd_doc — id этого текста, сохранённого в истории (HistoryDatabase.save_document):
+    тогда kd_evidence и diff не заполняются (None) и вычисляются только при чтении строки.
+    """
+    # КД сегментируется и токенизируется один раз на всё сравнение
+    if kd_index is None:
+        kd_index = KDIndex(kd_text)
+
+    scorer = BM25Scorer(kd_index) if resolve_score_mode(score_mode, kd_index) == "bm25" else None
+    if scorer is None:
+        # без матричного скоринга большая пачка ничего не экономит, а строки приходили бы рывками
+        chunk_size = min(chunk_size, HEURISTIC_CHUNK_SIZE)
+
+    for chunk, batch in _iter_chunks(requirements, chunk_size):
+        candidates: List[Optional[List[int]]] = [None] * len(chunk)
+        if scorer is not None:
+            pending = [i for i, req in enumerate(chunk) if req.num not in kd_index.refs]
+            top = scorer.top_k([chunk[i].text for i in pending])
+            for i, c in zip(pending, top):
+                candidates[i] = c.tolist()
+
+        matches: List[Dict[str, Any]] = []
+        for req, cand in zip(chunk, candidates):
+            t0 = time.perf_counter()
+            with stage("find_best_block", items=1):
+                matches.append(find_best_block(
+                    kd_text=kd_index.kd_text,
+                    req_num=req.num,
+                    req_text=req.text,
+                    req_nums_units=req.nums_units,
+                    kd_index=kd_index,
+                    candidates=cand,
+                ))
+            # распределение времени сопоставления по требованиям (для "самых медленных")
+            observe("match", time.perf_counter() - t0, req.req_id)
+
+        with stage("eval_constraints", items=len(chunk)):
+            evals = eval_constraints_batch(batch, matches, kd_index=kd_index, scale_units=scale_units)
+
+        for req, best, (sat, tot, note) in zip(chunk, matches, evals):
+            yield _make_row(req, best, sat, tot, note, kd_doc=kd_doc)
+
+def compare_requirements(
+        requirements,
+        kd_text: str,
+        kd_index: Optional[KDIndex] = None,
+        score_mode: str = "auto",
+        scale_units: bool = False,
+) -> list[dict[str, Any]]:
+    return list(iter_compare_requirements(requirements, kd_text, kd_index=kd_index, score_mode=score_mode,
+                                          scale_units=scale_units))
@@ -0,0 +1,222 @@
+"""
+Извлечение чисел с единицами и ограничений ("не менее", "не более", "от ... до ...")
+из текста требований ТТЗ и фрагментов КД.
+
+Все виды ищутся за один проход по тексту: объединённое регулярное выражение
+из опережающих проверок отмечает позиции, где начинается совпадение какого-либо
+вида, а пересечения отсекаются по каждому виду отдельно — результат тот же,
+что у отдельного finditer на каждый вид. Факты фрагмента КД мемоизируются:
+один и тот же блок КД проверяется против многих требований.
+
+Ограничения — неизменяемые кортежи Constraint, единицы интернируются: на сотнях
+тысяч требований одна и та же строка "вт" хранится один раз.
+"""
+import re
+import sys
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+_NUM = r"(\d+(?:[.,]\d+)?)"
+_UNIT = r"([^\s,;:.]+)?"
+
+_SOURCES = {
+    # Числа + единицы
+    "num_unit": _NUM + r"\s*(лм|в|вт|кг|г|мм|см|м|а|ма|ач|мбит/с|бит/с|гб|%|℃|°c|град/сек|мгц|дбмвт|ip\d{2})",
+    # Ограничения "не менее/не более/от...до..."
+    "min": r"\b(?:не\s+менее|не\s+ниже|минимум)\s+" + _NUM + r"\s*" + _UNIT,
+    "max": r"\b(?:не\s+более|не\s+выше|максимум)\s+" + _NUM + r"\s*" + _UNIT,
+    "range": r"\bот\s+" + _NUM + r"\s*" + _UNIT + r"\s+до\s+" + _NUM + r"\s*" + _UNIT,
+}
+
+NUM_UNIT_RE = re.compile(_SOURCES["num_unit"], re.I)
+MIN_RE = re.compile(_SOURCES["min"], re.I)
+MAX_RE = re.compile(_SOURCES["max"], re.I)
+RANGE_RE = re.compile(_SOURCES["range"], re.I)
+
+_KIND_RE = {"num_unit": NUM_UNIT_RE, "min": MIN_RE, "max": MAX_RE, "range": RANGE_RE}
+
+# В одной позиции может начинаться совпадение только одного вида
+# (число / "не менее" / "не более" / "от"), поэтому хватает альтернативы
+_ANY_RE = re.compile(
+    "|".join(f"(?=(?P<{kind}>{src}))" for kind, src in _SOURCES.items()),
+    re.I,
+)
+
+class Constraint(NamedTuple):
+    """
+    Числовое ограничение. Для ">=", "<=" и "raw" задано value,
+    для "range" — min и max; unit — нормализованная единица ("" — без единицы).
+    """
+    op: str                           # ">=" / "<=" / "range" / "raw"
+    value: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    unit: str = ""
+
+class TextFacts(NamedTuple):
+    nums_units: List[Tuple[str, str]]     # ("12.5", "вт") — число строкой, как в тексте (запятая -> точка)
+    ranges: List[Constraint]
+    mins: List[Constraint]
+    maxs: List[Constraint]
+
+def norm_unit(u: Optional[str]) -> str:
+    if not u:
+        return ""
+    return sys.intern(u.strip().lower().replace("°c", "℃"))
+
+def to_float(x: str) -> float:
+    return float(x.replace(",", "."))
+
+def scan_text(text: str) -> TextFacts:
+    """Один проход по тексту: числа с единицами и ограничения всех видов, в порядке появления"""
+    facts = TextFacts([], [], [], [])
+    # конец последнего принятого совпадения по каждому виду (как у finditer)
+    ends = dict.fromkeys(_SOURCES, 0)
+
+    for m in _ANY_RE.finditer(text):
+        kind = m.lastgroup
+        start, end = m.span(kind)
+        if start < ends[kind]:
+            continue
+        ends[kind] = end
+
+        g = _KIND_RE[kind].match(text, start).groups()
+        if kind == "num_unit":
+            facts.nums_units.append((g[0].replace(",", "."), norm_unit(g[1])))
+        elif kind == "range":
+            facts.ranges.append(Constraint("range", min=to_float(g[0]), max=to_float(g[2]),
+                                           unit=norm_unit(g[1] or g[3])))
+        elif kind == "min":
+            facts.mins.append(Constraint(">=", to_float(g[0]), unit=norm_unit(g[1])))
+        else:
+            facts.maxs.append(Constraint("<=", to_float(g[0]), unit=norm_unit(g[1])))
+
+    return facts
+
+def constraints_from_facts(facts: TextFacts) -> List[Constraint]:
+    """
+    Список ограничений: >=, <=, range.
+    Если явных ограничений нет, но есть числа+единицы — они сохраняются как "raw"
+    (это помогает в скоринге, даже если проверить строго нельзя).
+    """
+    out = facts.ranges + facts.mins + facts.maxs
+    if not out:
+        out = [Constraint("raw", float(a), unit=b) for a, b in facts.nums_units]
+    return out
+
+def extract_constraints(text: str) -> List[Constraint]:
+    return constraints_from_facts(scan_text(text))
+
+@lru_cache(maxsize=8192)
+def kd_facts(snippet: str) -> Tuple[Tuple[Tuple[float, str], ...], Tuple[Constraint, ...]]:
+    """
+    Значения (число, единица) и явные ограничения фрагмента КД.
+    Мемоизируется по тексту фрагмента.
+    """
+    facts = scan_text(snippet)
+    values = tuple((float(a), u) for a, u in facts.nums_units)
+    return values, tuple(facts.ranges + facts.mins + facts.maxs)
+
+# Ключ NumberIndex, под которым лежат значения всех единиц
+ANY_UNIT = ""
+
+# Семейства единиц для сравнения с пересчётом (по желанию): единица -> (базовая, множитель)
+UNIT_FAMILIES: Dict[str, Tuple[str, float]] = {
+    "мм": ("м", 0.001), "см": ("м", 0.01), "м": ("м", 1.0),
+    "ма": ("а", 0.001), "а": ("а", 1.0),
+    "г": ("кг", 0.001), "кг": ("кг", 1.0),
+    "бит/с": ("бит/с", 1.0), "мбит/с": ("бит/с", 1e6),
+}
+
+def family_units(unit: str) -> List[Tuple[str, float]]:
+    """Все единицы семейства unit с множителями к базовой (для единицы вне семейств — она сама)"""
+    base = UNIT_FAMILIES.get(unit, (unit, 1.0))[0]
+    units = [(u, k) for u, (b, k) in UNIT_FAMILIES.items() if b == base]
+    return units or [(unit, 1.0)]
+
+class _UnitValues:
+    """Значения одной единицы: по смещению в тексте и (отдельно) по величине"""
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.values: List[float] = []
+        self.blocks: List[int] = []
+        self.sorted_values: List[float] = []
+        self.sorted_blocks: List[int] = []
+
+    def freeze(self):
+        order = sorted(range(len(self.values)), key=self.values.__getitem__)
+        self.sorted_values = [self.values[i] for i in order]
+        self.sorted_blocks = [self.blocks[i] for i in order]
+
+class NumberIndex:
+    """
+    Все числа с единицами КД: (значение, единица, смещение, номер блока).
+    Для каждой единицы — массивы, упорядоченные по смещению (значения в фрагменте)
+    и по величине (блоки со значением в диапазоне); запросы — двоичным поиском.
+    Для скоринга блоков значения дополнительно сгруппированы по блоку и единице.
+    """
+
+    def __init__(self, text: str, block_spans: Sequence[Tuple[int, int]]):
+        self.block_spans = list(block_spans)
+        block_starts = [a for a, _ in self.block_spans]
+        self._units: Dict[str, _UnitValues] = {}
+        self.by_block: List[Dict[str, List[float]]] = [{} for _ in self.block_spans]
+
+        for m in NUM_UNIT_RE.finditer(text):
+            start, end = m.span()
+            value, unit = to_float(m.group(1)), norm_unit(m.group(2))
+            block = bisect_right(block_starts, start) - 1
+            if block >= 0 and start >= self.block_spans[block][1]:
+                block = -1
+            if block >= 0:
+                self.by_block[block].setdefault(unit, []).append(value)
+            for key in (unit, ANY_UNIT):
+                uv = self._units.get(key)
+                if uv is None:
+                    uv = self._units[key] = _UnitValues()
+                uv.starts.append(start)
+                uv.ends.append(end)
+                uv.values.append(value)
+                uv.blocks.append(block)
+
+        for uv in self._units.values():
+            uv.freeze()
+
+    def values_in_span(self, unit: str, start: int, end: int) -> List[float]:
+        """Значения в единице unit (ANY_UNIT — в любой), целиком лежащие в [start, end), по порядку текста"""
+        uv = self._units.get(unit)
+        if uv is None:
+            return []
+        a = bisect_left(uv.starts, start)
+        b = bisect_right(uv.ends, end)
+        return uv.values[a:b] if b > a else []
+
+    def first_in_span_at(self, unit: str, start: int, end: int) -> Optional[Tuple[int, float]]:
+        """(смещение, значение) первого по тексту значения в единице unit внутри [start, end)"""
+        uv = self._units.get(unit)
+        if uv is None:
+            return None
+        i = bisect_left(uv.starts, start)
+        if i < len(uv.starts) and uv.ends[i] <= end:
+            return uv.starts[i], uv.values[i]
+        return None
+
+    def first_in_span(self, unit: str, start: int, end: int) -> Optional[float]:
+        hit = self.first_in_span_at(unit, start, end)
+        return hit[1] if hit else None
+
+    def block_values(self, block: int, unit: str) -> List[float]:
+        """Значения в единице unit внутри блока"""
+        return self.by_block[block].get(unit, [])
+
+    def blocks_with_value(self, unit: str, lo: Optional[float] = None, hi: Optional[float] = None) -> Set[int]:
+        """Номера блоков, где есть значение в единице unit из [lo, hi] (None — без границы)"""
+        uv = self._units.get(unit)
+        if uv is None:
+            return set()
+        a = 0 if lo is None else bisect_left(uv.sorted_values, lo)
+        b = len(uv.sorted_values) if hi is None else bisect_right(uv.sorted_values, hi)
+        return {blk for blk in uv.sorted_blocks[a:b] if blk >= 0}
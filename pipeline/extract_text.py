@@ -1,47 +1,384 @@
 import io
+import mmap
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from xml.etree.ElementTree import iterparse
+
 import fitz  # PyMuPDF
 from docx import Document
 
-def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+from pipeline.ocr import OCR_BUDGET_SEC, OCR_DPI, OCR_WORKERS, OCREngine, needs_ocr, run_ocr
+from pipeline.profiling import stage, timed
+
+# Меняется при любом изменении логики извлечения — инвалидирует ExtractCache
+EXTRACTOR_VERSION = "2"
+
+# PDF короче этого числа страниц разбираем в одном процессе: пул дороже выигрыша
+PARALLEL_MIN_PAGES = 64
+# Сколько страниц отдаём воркеру за одну задачу
+PAGES_PER_TASK = 16
+
+# Источник для извлечения: содержимое файла (bytes / memoryview / mmap) или путь к нему.
+# По пути PDF открывается без чтения в память, DOCX читается из zip потоково.
+Source = Union[bytes, bytearray, memoryview, mmap.mmap, str, os.PathLike]
+
+def _is_path(source: Source) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+def _open_pdf(source: Source) -> fitz.Document:
+    if _is_path(source):
+        return fitz.open(source, filetype="pdf")
+    # PyMuPDF принимает memoryview (в том числе над mmap), но не сам mmap
+    return fitz.open(stream=memoryview(source), filetype="pdf")
+
+class _BufferReader(io.RawIOBase):
+    """Файл только для чтения поверх буфера (mmap, memoryview) — без копии содержимого"""
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def close(self):
+        # освобождаем буфер, иначе mmap нельзя будет закрыть
+        self._view.release()
+        super().close()
+
+def _open_binary(source: Source):
+    """Файловый объект для zipfile / python-docx: файл по пути или чтение прямо из буфера"""
+    if _is_path(source):
+        return open(source, "rb")
+    if isinstance(source, bytes):
+        return io.BytesIO(source)
+    return _BufferReader(source)
+
+# Документ, открытый в процессе-воркере (см. _init_pdf_worker)
+_worker_doc = None
+
+def _init_pdf_worker(pdf_source: Union[str, os.PathLike]):
+    global _worker_doc
+    _worker_doc = _open_pdf(pdf_source)
+
+def _extract_page_range(start: int, end: int) -> List[Tuple[int, str, float]]:
+    out = []
+    for i in range(start, end):
+        t0 = time.perf_counter()
+        text = _worker_doc.load_page(i).get_text("text")
+        out.append((i, text, time.perf_counter() - t0))
+    return out
+
+def iter_pdf_pages(
+        pdf_bytes: Source,
+        workers: Optional[int] = None,
+        meta: Optional[Dict] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Отдаёт (номер страницы с 1, текст) строго в порядке документа,
+    по мере готовности страниц.
+    pdf_bytes — содержимое PDF или путь к нему (см. Source).
+    workers — размер пула процессов (None = число ядер); короткие PDF
+    (< PARALLEL_MIN_PAGES) всегда разбираются в текущем процессе.
+    В meta (если передан) пишутся page_count, workers и page_times (сек/страница).
+    """
+    doc = _open_pdf(pdf_bytes)
+    page_count = doc.page_count
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if page_count < PARALLEL_MIN_PAGES:
+        workers = 1
+    workers = max(1, min(workers, -(-page_count // PAGES_PER_TASK)))
+
+    page_times: List[float] = [0.0] * page_count
+    if meta is not None:
+        meta["page_count"] = page_count
+        meta["workers"] = workers
+        meta["page_times"] = page_times
+
+    if workers == 1:
+        try:
+            for i in range(page_count):
+                t0 = time.perf_counter()
+                text = doc.load_page(i).get_text("text")
+                page_times[i] = time.perf_counter() - t0
+                yield i + 1, text
+        finally:
+            # документ держит файл / буфер (mmap не закроется, пока на него есть ссылки)
+            doc.close()
+        return
+
+    doc.close()
+    # воркерам — путь (каждый откроет файл сам); буфер выгружается во временный файл,
+    # а не копируется целиком в память для передачи каждому процессу
+    spooled = None
+    if _is_path(pdf_bytes):
+        pdf_path = pdf_bytes
+    else:
+        with _open_binary(pdf_bytes) as src, tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            shutil.copyfileobj(src, f, 1024 * 1024)
+        pdf_path = spooled = f.name
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_pdf_worker,
+                initargs=(pdf_path,),
+        ) as pool:
+            futures = [
+                pool.submit(_extract_page_range, a, min(a + PAGES_PER_TASK, page_count))
+                for a in range(0, page_count, PAGES_PER_TASK)
+            ]
+            # Порядок задач = порядок страниц, поэтому ждём их по очереди
+            for fut in futures:
+                for i, text, dt in fut.result():
+                    page_times[i] = dt
+                    yield i + 1, text
+    finally:
+        if spooled:
+            os.remove(spooled)
+
+def _ocr_low_text_pages(
+        pdf_bytes: Source,
+        parts: List[str],
+        low_pages: List[int],
+        engine: Union[str, OCREngine],
+        meta: Dict,
+        workers: int = OCR_WORKERS,
+        budget: float = OCR_BUDGET_SEC,
+        dpi: int = OCR_DPI,
+):
+    """
+    OCR страниц low_pages (номера с 1): распознанный текст заменяет текстовый слой
+    страницы в parts (на своём месте — порядок страниц сохраняется), отчёт — в meta.
+    Страницы без изображений не рендерятся: распознавать на них нечего.
+    """
+    doc = _open_pdf(pdf_bytes)
+
+    def render(page_no: int) -> Optional[bytes]:
+        page = doc.load_page(page_no - 1)
+        if not page.get_images():
+            return None
+        return page.get_pixmap(dpi=dpi).tobytes("png")
+
+    try:
+        with stage("ocr") as st:
+            texts, report = run_ocr(low_pages, render, engine, workers=workers, budget=budget)
+            st.items = len(texts)
+    finally:
+        doc.close()
+
+    for page_no, text in texts.items():
+        if text.strip():
+            parts[page_no - 1] = text
+    meta.update(report)
+
+def extract_text_from_pdf_bytes(
+        pdf_bytes: Source,
+        workers: Optional[int] = 1,
+        meta: Optional[Dict] = None,
+        on_page: Optional[Callable[[int, int], None]] = None,
+        ocr: Union[None, str, OCREngine] = None,
+        ocr_workers: int = OCR_WORKERS,
+        ocr_budget: float = OCR_BUDGET_SEC,
+) -> str:
+    """
+    ocr — OCR-движок (или его имя, см. pipeline.ocr) для страниц почти без текстового слоя
+    (needs_ocr); None — OCR выключен. Такие страницы отмечаются по ходу разбора, а
+    распознаются после него в пуле из ocr_workers потоков за ocr_budget секунд на документ.
+    """
+    meta = {} if meta is None else meta
     parts = []
-    for i in range(doc.page_count):
-        parts.append(doc.load_page(i).get_text("text"))
+    low_pages: List[int] = []
+    for page_no, text in iter_pdf_pages(pdf_bytes, workers=workers, meta=meta):
+        parts.append(text)
+        if ocr is not None and needs_ocr(text):
+            low_pages.append(page_no)
+        if on_page:
+            on_page(page_no, meta["page_count"])
+    if low_pages:
+        _ocr_low_text_pages(pdf_bytes, parts, low_pages, ocr, meta, workers=ocr_workers, budget=ocr_budget)
     return "\n".join(parts).strip()
 
-def extract_text_from_docx_bytes(docx_bytes: bytes) -> str:
-    f = io.BytesIO(docx_bytes)
-    doc = Document(f)
-    return "\n".join(p.text for p in doc.paragraphs).strip()
+# Пространства имён WordprocessingML: Transitional (обычный .docx) и Strict
+_W_NAMESPACES = (
+    "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "http://purl.oclc.org/ooxml/wordprocessingml/main",
+)
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+def _w_tags(name: str) -> frozenset:
+    return frozenset(f"{{{ns}}}{name}" for ns in _W_NAMESPACES)
 
-def extract_text(file_bytes: bytes, filename: str) -> tuple[str, dict]:
+_W_P, _W_TBL, _W_TR, _W_TC = _w_tags("p"), _w_tags("tbl"), _w_tags("tr"), _w_tags("tc")
+_W_T = _w_tags("t")
+_W_TAB = _w_tags("tab") | _w_tags("ptab")
+_W_BR = _w_tags("br") | _w_tags("cr")
+_W_HYPHEN = _w_tags("noBreakHyphen")
+_W_TYPE = frozenset(f"{{{ns}}}type" for ns in _W_NAMESPACES)
+
+DOCX_MAIN_PART = "word/document.xml"
+# Разделитель ячеек строки таблицы (не склеивается с числами и единицами)
+DOCX_CELL_SEP = " | "
+
+def iter_docx_lines(docx_bytes: Source) -> Iterator[str]:
+    """
+    Потоково читает word/document.xml прямо из zip (iterparse, без DOM python-docx)
+    и отдаёт строки текста в порядке документа:
+      - абзац — строка (как paragraph.text: w:tab -> "\t", перенос w:br -> "\n");
+      - строка таблицы — ячейки через DOCX_CELL_SEP (абзацы ячейки — через пробел),
+        после каждой строки таблицы и перед таблицей — пустая строка, поэтому
+        split_into_blocks делает из каждой строки таблицы отдельный блок.
+    Вложенные таблицы попадают в текст ячейки внешней; запасное содержимое
+    mc:Fallback (дубль надписей) пропускается.
+    Обработанные элементы сразу удаляются из дерева — память не растёт с размером документа.
+    """
+    with _open_binary(docx_bytes) as fp, zipfile.ZipFile(fp) as zf, zf.open(DOCX_MAIN_PART) as f:
+        stack = []              # открытые элементы (для удаления обработанных из родителя)
+        paragraphs: List[List[str]] = []   # части текста открытых абзацев (надписи — вложенные)
+        cells: List[List[str]] = []        # абзацы открытых ячеек
+        rows: List[List[str]] = []         # ячейки открытых строк таблиц
+        table_depth = 0
+        skip_depth = 0          # внутри mc:Fallback
+
+        for event, elem in iterparse(f, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                stack.append(elem)
+                if skip_depth or tag == _MC_FALLBACK:
+                    skip_depth += 1
+                elif tag in _W_P:
+                    paragraphs.append([])
+                elif tag in _W_TC:
+                    cells.append([])
+                elif tag in _W_TR:
+                    rows.append([])
+                elif tag in _W_TBL:
+                    table_depth += 1
+                    if table_depth == 1:
+                        yield ""
+                continue
+
+            stack.pop()
+            if stack:
+                stack[-1].remove(elem)
+
+            if skip_depth:
+                skip_depth -= 1
+                continue
+            if tag in _W_T:
+                if elem.text and paragraphs:
+                    paragraphs[-1].append(elem.text)
+            elif tag in _W_TAB:
+                if paragraphs:
+                    paragraphs[-1].append("\t")
+            elif tag in _W_BR:
+                br_type = next((v for k, v in elem.attrib.items() if k in _W_TYPE), None)
+                if paragraphs and br_type in (None, "textWrapping"):
+                    paragraphs[-1].append("\n")
+            elif tag in _W_HYPHEN:
+                if paragraphs:
+                    paragraphs[-1].append("-")
+            elif tag in _W_P:
+                text = "".join(paragraphs.pop())
+                if paragraphs:
+                    # абзац надписи внутри абзаца
+                    paragraphs[-1].append(" " + text)
+                elif cells:
+                    cells[-1].append(text)
+                else:
+                    yield text
+            elif tag in _W_TC:
+                text = " ".join(t.strip() for t in cells.pop() if t.strip())
+                if rows:
+                    rows[-1].append(text)
+            elif tag in _W_TR:
+                row = rows.pop()
+                if table_depth > 1 and cells:
+                    # вложенная таблица — в текст ячейки внешней
+                    cells[-1].append(DOCX_CELL_SEP.join(c for c in row if c))
+                else:
+                    yield DOCX_CELL_SEP.join(row)
+                    yield ""
+            elif tag in _W_TBL:
+                table_depth -= 1
+
+def extract_text_from_docx_bytes(docx_bytes: Source) -> str:
+    """Текст DOCX с абзацами и таблицами (iter_docx_lines); без word/document.xml — через python-docx"""
+    try:
+        return "\n".join(iter_docx_lines(docx_bytes)).strip()
+    except KeyError:
+        # основная часть документа под нестандартным именем: python-docx найдёт её по связям
+        with _open_binary(docx_bytes) as fp:
+            doc = Document(fp)
+        return "\n".join(p.text for p in doc.paragraphs).strip()
+
+@timed("extract_text", items=lambda r: r[1].get("page_count", 1))
+def extract_text(
+        file_bytes: Source,
+        filename: str,
+        workers: Optional[int] = None,
+        on_page: Optional[Callable[[int, int], None]] = None,
+        ocr: Union[None, str, OCREngine] = None,
+        ocr_workers: int = OCR_WORKERS,
+        ocr_budget: float = OCR_BUDGET_SEC,
+) -> tuple[str, dict]:
     """
     Returns: (text, meta)
-    meta can store stats and later OCR artifacts.
+    meta stores extraction stats and OCR artifacts.
+    file_bytes — file content (bytes, memoryview, mmap) or a filesystem path;
+    with a path PDF pages are read lazily and the file is never loaded as a whole.
+    workers / on_page(page_no, page_count) apply to PDF only.
+    ocr — OCR engine or its registered name (see pipeline.ocr); when set, PDF pages
+    with (almost) no text layer are OCRed in a pool of ocr_workers threads within
+    ocr_budget seconds per document. meta then gets ocr_engine, ocr_pages, ocr_times
+    (seconds per OCRed page), ocr_skipped and ocr_errors.
     """
     name = filename.lower().strip()
     meta = {"method": None, "text_len": 0}
 
     if name.endswith(".pdf"):
-        text = extract_text_from_pdf_bytes(file_bytes)
-        meta["method"] = "pdf_text"
+        text = extract_text_from_pdf_bytes(file_bytes, workers=workers, meta=meta, on_page=on_page,
+                                           ocr=ocr, ocr_workers=ocr_workers, ocr_budget=ocr_budget)
+        meta["method"] = "pdf_text+ocr" if meta.get("ocr_pages") else "pdf_text"
     elif name.endswith(".docx"):
         text = extract_text_from_docx_bytes(file_bytes)
-        meta["method"] = "docx_text"
+        meta["method"] = "docx_stream"
     else:
         # For MVP: treat as plain text if possible
         try:
-            text = file_bytes.decode("utf-8", errors="ignore")
+            if _is_path(file_bytes):
+                # newline="" — переводы строк как в файле (как при decode содержимого)
+                with open(file_bytes, encoding="utf-8", errors="ignore", newline="") as f:
+                    text = f.read()
+            else:
+                text = str(file_bytes, "utf-8", "ignore")
             meta["method"] = "plain_decode"
         except Exception:
             text = ""
             meta["method"] = "unknown"
 
     meta["text_len"] = len(text)
-
-    # FUTURE HOOK:
-    # if meta["text_len"] < SOME_THRESHOLD:
-    #    text = run_ocr_vlm(file_bytes, filename)
-    #    meta["method"] = "ocr_vlm"
-
     return text, meta
@@ -1,5 +1,10 @@
+import difflib
+import itertools
 import re
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any, Tuple, Set, Iterable, Sequence
+
+from pipeline.constraints import NumberIndex, kd_facts
+from pipeline.profiling import stage
 
 STOPWORDS = {
     "и","в","во","на","по","к","с","со","из","для","не","что","это","как",
@@ -14,7 +19,9 @@ def normalize_text(s: str) -> str:
     return s.strip()
 
 def tokenize(s: str) -> List[str]:
-    s = normalize_text(s)
+    return _tokenize_normalized(normalize_text(s))
+
+def _tokenize_normalized(s: str) -> List[str]:
     tokens = re.split(r"[^a-zа-я0-9%℃°./\-]+", s)
     out = []
     for t in tokens:
@@ -25,65 +32,151 @@ def tokenize(s: str) -> List[str]:
         out.append(t)
     return out
 
-def split_into_blocks(kd_text: str) -> List[str]:
+def normalize_newlines(s: str) -> str:
+    return s.replace("\r\n", "\n").replace("\r", "\n")
+
+def _strip_span(text: str, a: int, b: int) -> Tuple[int, int]:
+    while a < b and text[a].isspace():
+        a += 1
+    while b > a and text[b - 1].isspace():
+        b -= 1
+    return a, b
+
+def split_into_block_spans(text: str) -> List[List[Tuple[int, int]]]:
     """
-    Делим КД на смысловые блоки.
-    1) Сначала по пустым строкам
-    2) Если пустых строк нет — по "длинным" переносам
+    Делим КД (с переводами строк "\n") на смысловые блоки; блок — список отрезков текста,
+    склеиваемых через пробел (см. block_text).
+    1) Сначала по пустым строкам — блок это один отрезок
+    2) Если пустых строк нет — по "длинным" переносам: строки склеиваются до ~700 символов
     """
-    text = kd_text.replace("\r\n", "\n").replace("\r", "\n")
-    parts = [p.strip() for p in re.split(r"\n\s*\n+", text) if p.strip()]
+    parts: List[List[Tuple[int, int]]] = []
+    pos = 0
+    for m in itertools.chain(re.finditer(r"\n\s*\n+", text), [None]):
+        a, b = _strip_span(text, pos, m.start() if m else len(text))
+        if b > a:
+            parts.append([(a, b)])
+        if m:
+            pos = m.end()
     if len(parts) >= 5:
         return parts
 
     # fallback: резать по строкам и склеивать в блоки
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
-    blocks: List[str] = []
-    buf: List[str] = []
-    for l in lines:
-        buf.append(l)
-        if len(" ".join(buf)) >= 700:
-            blocks.append(" ".join(buf))
+    lines: List[Tuple[int, int]] = []
+    pos = 0
+    for line in text.split("\n"):
+        a, b = _strip_span(text, pos, pos + len(line))
+        if b > a:
+            lines.append((a, b))
+        pos += len(line) + 1
+    blocks: List[List[Tuple[int, int]]] = []
+    buf: List[Tuple[int, int]] = []
+    joined = -1
+    for a, b in lines:
+        buf.append((a, b))
+        joined += b - a + 1
+        if joined >= 700:
+            blocks.append(buf)
             buf = []
+            joined = -1
     if buf:
-        blocks.append(" ".join(buf))
-    return blocks or [kd_text.strip()]
+        blocks.append(buf)
+    return blocks or [[_strip_span(text, 0, len(text))]]
+
+def block_text(text: str, spans: List[Tuple[int, int]]) -> str:
+    return " ".join(text[a:b] for a, b in spans)
+
+def block_offset(spans: List[Tuple[int, int]], k: int) -> int:
+    """Смещение в тексте КД для позиции k в block_text (пробел-склейка -> конец строки)"""
+    for a, b in spans:
+        if k <= b - a:
+            return a + k
+        k -= b - a + 1
+    return spans[-1][1]
+
+def split_into_blocks(kd_text: str) -> List[str]:
+    """
+    Делим КД на смысловые блоки.
+    1) Сначала по пустым строкам
+    2) Если пустых строк нет — по "длинным" переносам
+    """
+    text = normalize_newlines(kd_text)
+    return [block_text(text, spans) for spans in split_into_block_spans(text)]
+
+# Ссылки на пункты ТЗ: "п. 2.2.2 ТЗ" / "2.2.2 ТЗ" / "пункт 2.2.2".
+# Номер пункта захватывается группой, поэтому один проход находит ссылки на все пункты сразу.
+_REF_NUM = r"\d+(?:\.\d+)+"
+_REF_TAIL = r"(?:тз|техническ\w*\s+задан\w*)"
+EXPLICIT_REF_RE = re.compile(
+    rf"(?is)п\.\s*(?P<n1>{_REF_NUM})\s*{_REF_TAIL}"
+    rf"|(?<![\d.])(?P<n2>{_REF_NUM})\s*{_REF_TAIL}"
+    rf"|пункт\w*\s+(?P<n3>{_REF_NUM})"
+)
+
+def scan_explicit_refs(kd_text: str) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Один проход по КД: номер пункта ТЗ -> список (start, end) ссылок на него.
+    Шаблон нечувствителен к регистру и к количеству пробелов, поэтому сканируется
+    исходный текст и смещения сразу пригодны для pick_window(kd_text, ...).
+    """
+    refs: Dict[str, List[Tuple[int, int]]] = {}
+    for m in EXPLICIT_REF_RE.finditer(kd_text):
+        num = m.group("n1") or m.group("n2") or m.group("n3")
+        refs.setdefault(num, []).append((m.start(), m.end()))
+    return refs
 
 def find_all_explicit_refs(kd_text: str, req_num: str) -> List[Tuple[int, int]]:
     """
     Находит все вхождения ссылок вида "п. 2.2.2 ТЗ" / "2.2.2 ТЗ" / "пункт 2.2.2"
     """
-    n = re.escape(req_num)
-    pat = re.compile(rf"(?is)(п\.\s*{n}\s*(?:тз|техническ\w*\s+задан\w*)|{n}\s*(?:тз|техническ\w*\s+задан\w*)|пункт\w*\s+{n})")
-    return [(m.start(), m.end()) for m in pat.finditer(kd_text)]
+    return scan_explicit_refs(kd_text).get(req_num, [])
+
+# Пометка в конце обрезанного фрагмента (в span не входит)
+EVIDENCE_CUT_MARK = "..."
 
 def pick_window(kd_text: str, start: int, end: int, window: int = 450) -> str:
     a = max(0, start - window)
     b = min(len(kd_text), end + window)
     return kd_text[a:b].strip()
 
+def diff_summary(a: str, b: str, max_lines: int = 8) -> str:
+    a_lines = [a.strip()]
+    b_lines = [b.strip()]
+    d = list(difflib.unified_diff(a_lines, b_lines, lineterm=""))
+    out = [line for line in d if line.startswith(("+", "-", "@@"))][:max_lines]
+    return "\n".join(out).strip()
+
 def score_block(req_tokens: List[str], req_nums_units: List[tuple[str,str]], block: str) -> float:
     """
     Скоринг блока по:
     - совпадению токенов (Jaccard-like)
     - наличию чисел/единиц
     """
-    bt = tokenize(block)
-    if not bt:
+    unit_values: Dict[str, List[float]] = {}
+    for v, u in kd_facts(block)[0]:
+        unit_values.setdefault(u, []).append(v)
+    return _score_normalized(
+        set(req_tokens),
+        [(float(n), u) for n, u in req_nums_units],
+        set(tokenize(block)),
+        unit_values,
+    )
+
+def _score_normalized(rset: Set[str], req_values: List[Tuple[float, str]], bset: Set[str],
+                      unit_values: Dict[str, List[float]]) -> float:
+    """unit_values — значения блока по единицам"""
+    if not bset:
         return 0.0
-    bset = set(bt)
-    rset = set(req_tokens)
 
     overlap = len(rset & bset)
     denom = max(1, len(rset))
     tok_score = overlap / denom
 
     num_score = 0.0
-    s = normalize_text(block)
-    for num, unit in req_nums_units:
-        if num and (num in s):
+    for value, unit in req_values:
+        vals = unit_values.get(unit, ())
+        if value in vals:
             num_score += 0.6
-        if unit and (unit in s):
+        if vals:
             num_score += 0.4
 
     # ограничим
@@ -91,50 +184,117 @@ def score_block(req_tokens: List[str], req_nums_units: List[tuple[str,str]], blo
 
     return tok_score * 3.0 + num_score
 
+class KDIndex:
+    """
+    Индекс КД, который строится один раз на сравнение:
+    блоки (и их отрезки в kd_text), нормализованный текст, множества токенов,
+    обратный индекс токен -> номера блоков, явные ссылки на пункты ТЗ
+    и индекс чисел с единицами. Переводы строк в kd_text приводятся к "\n",
+    все смещения — в этом тексте.
+    """
+
+    def __init__(self, kd_text: str):
+        with stage("kd_index") as st:
+            self.kd_text = normalize_newlines(kd_text)
+            self.refs: Dict[str, List[Tuple[int, int]]] = scan_explicit_refs(self.kd_text)
+            self.block_spans: List[List[Tuple[int, int]]] = split_into_block_spans(self.kd_text)
+            self.blocks: List[str] = [block_text(self.kd_text, spans) for spans in self.block_spans]
+            self.numbers = NumberIndex(self.kd_text, [(spans[0][0], spans[-1][1]) for spans in self.block_spans])
+            self.block_norm: List[str] = [normalize_text(b) for b in self.blocks]
+            self.block_tokens: List[Set[str]] = [set(_tokenize_normalized(b)) for b in self.block_norm]
+
+            self.postings: Dict[str, List[int]] = {}
+            for i, toks in enumerate(self.block_tokens):
+                for t in toks:
+                    self.postings.setdefault(t, []).append(i)
+            st.items = len(self.blocks)
+
+    def candidates(self, req_tokens: Iterable[str],
+                   req_values: Iterable[Tuple[float, str]] = ()) -> List[int]:
+        """
+        Номера блоков, у которых есть хотя бы один общий токен с требованием
+        или то же значение в той же единице (в порядке КД).
+        """
+        ids: Set[int] = set()
+        for t in set(req_tokens):
+            ids.update(self.postings.get(t, ()))
+        for value, unit in req_values:
+            ids.update(self.numbers.blocks_with_value(unit, value, value))
+        return sorted(ids)
+
 def find_best_block(
         kd_text: str,
         req_num: str,
         req_text: str,
-        req_nums_units: List[tuple[str,str]]
+        req_nums_units: List[tuple[str,str]],
+        kd_index: Optional[KDIndex] = None,
+        candidates: Optional[Sequence[int]] = None,
 ) -> Dict[str, Any]:
     """
     Возвращает:
       {
         "evidence": "...",
         "match_type": "...",
-        "score": float
+        "score": float,
+        "span": (start, end) фрагмента в kd_index.kd_text или None,
+        "cut": bool — блок обрезан
       }
+    evidence — ровно kd_index.kd_text[start:end] (плюс EVIDENCE_CUT_MARK, если cut), поэтому
+    по span и cut фрагмент восстанавливается из сохранённого текста КД без копии в строке результата.
+    Если передан kd_index, КД повторно не сегментируется и не токенизируется,
+    а скорятся только блоки с общими токенами.
+    candidates — заранее отобранные номера блоков (например, top-k от BM25),
+    которые переранжируются той же эвристикой.
     """
-    kd_norm = normalize_text(kd_text)
+    if kd_index is None:
+        kd_index = KDIndex(kd_text)
     req_tokens = tokenize(req_text)
 
     # 1) Сильнейший сигнал: явная ссылка на пункт ТЗ
-    refs = find_all_explicit_refs(kd_norm, req_num)
+    refs = kd_index.refs.get(req_num)
     if refs:
         # берём первый лучший (обычно достаточно)
         start, end = refs[0]
+        a, b = max(0, start - 500), min(len(kd_index.kd_text), end + 500)
         return {
-            "evidence": pick_window(kd_text, start, end, window=500),
+            "evidence": pick_window(kd_index.kd_text, start, end, window=500),
             "match_type": "explicit_ref",
-            "score": 10.0
+            "score": 10.0,
+            "span": _strip_span(kd_index.kd_text, a, b),
+            "cut": False,
         }
 
-    # 2) Блочная эвристика: выбираем лучший блок по скорингу
-    blocks = split_into_blocks(kd_text)
-    best = {"evidence": "", "match_type": "", "score": 0.0}
+    # 2) Блочная эвристика: выбираем лучший блок по скорингу среди кандидатов
+    rset = set(req_tokens)
+    req_values = [(float(n), u) for n, u in req_nums_units]
+    by_block = kd_index.numbers.by_block
+    best_i = -1
+    best_score = 0.0
+
+    if candidates is None:
+        candidates = kd_index.candidates(rset, req_values)
 
-    for b in blocks:
-        sc = score_block(req_tokens, req_nums_units, b)
-        if sc > best["score"]:
-            best = {"evidence": b.strip(), "match_type": "scored_block", "score": sc}
+    for i in sorted(candidates):
+        sc = _score_normalized(rset, req_values, kd_index.block_tokens[i], by_block[i])
+        if sc > best_score:
+            best_i, best_score = i, sc
 
     # если совсем низкий скор — считаем не найдено
-    if best["score"] < 0.9:
-        return {"evidence": "", "match_type": "", "score": 0.0}
-
-    # Подрежем evidence чтобы не было слишком длинно
-    ev = best["evidence"]
-    if len(ev) > 1200:
-        ev = ev[:1200].rstrip() + "..."
-    best["evidence"] = ev
-    return best
+    if best_score < 0.9:
+        return {"evidence": "", "match_type": "", "score": 0.0, "span": None, "cut": False}
+
+    # Подрежем evidence чтобы не было слишком длинно (1200 символов блока)
+    spans = kd_index.block_spans[best_i]
+    ev = kd_index.blocks[best_i]
+    end = spans[-1][1]
+    cut = len(ev) > 1200
+    if cut:
+        end = block_offset(spans, len(ev[:1200].rstrip()))
+    start = spans[0][0]
+    return {
+        "evidence": kd_index.kd_text[start:end] + (EVIDENCE_CUT_MARK if cut else ""),
+        "match_type": "scored_block",
+        "score": best_score,
+        "span": (start, end),
+        "cut": cut,
+    }
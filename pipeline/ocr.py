@@ -0,0 +1,166 @@
+"""
+Постраничное распознавание (OCR) сканов в PDF.
+
+Текстовый слой извлекается как обычно; OCR получают только страницы, где текста
+почти нет (needs_ocr), — их изображения распознаются движком в ограниченном пуле
+потоков с общим бюджетом времени на документ. Движок подключаемый: любой объект
+с name и recognize(png, page_no); встроенные — "stub" (для тестов) и "tesseract"
+(если установлены pytesseract и Pillow).
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# Страница без текстового слоя: меньше стольких непробельных символов
+OCR_MIN_CHARS = 32
+# Потоков распознавания и бюджет времени на документ (сек)
+OCR_WORKERS = min(4, os.cpu_count() or 1)
+OCR_BUDGET_SEC = 120.0
+# Разрешение, в котором страница отдаётся движку
+OCR_DPI = 200
+
+# Движок по умолчанию для приложения и пакетного режима (не задан — OCR выключен)
+DEFAULT_ENGINE = os.environ.get("OCR_ENGINE") or None
+
+class OCREngine:
+    """Движок OCR: текст страницы по её изображению (PNG). Должен быть потокобезопасным."""
+    name = "base"
+
+    def recognize(self, png: bytes, page_no: int) -> str:
+        raise NotImplementedError
+
+class StubOCREngine(OCREngine):
+    """Локальная заглушка: ничего не распознаёт, возвращает text (с {page_no}) после delay секунд"""
+    name = "stub"
+
+    def __init__(self, text: str = "[OCR: страница {page_no}]", delay: float = 0.0):
+        self.text = text
+        self.delay = delay
+
+    def recognize(self, png: bytes, page_no: int) -> str:
+        if self.delay:
+            time.sleep(self.delay)
+        return self.text.format(page_no=page_no)
+
+class TesseractOCREngine(OCREngine):
+    """Tesseract через pytesseract (нужны pytesseract, Pillow и сам tesseract с языком rus)"""
+    name = "tesseract"
+
+    def __init__(self, lang: str = "rus+eng"):
+        import pytesseract
+        from PIL import Image
+
+        self._pytesseract = pytesseract
+        self._image = Image
+        self.lang = lang
+
+    def recognize(self, png: bytes, page_no: int) -> str:
+        import io
+
+        with self._image.open(io.BytesIO(png)) as img:
+            return self._pytesseract.image_to_string(img, lang=self.lang)
+
+_ENGINES: Dict[str, Callable[[], OCREngine]] = {
+    "stub": StubOCREngine,
+    "tesseract": TesseractOCREngine,
+}
+
+def register_engine(name: str, factory: Callable[[], OCREngine]):
+    """Подключает движок под именем name (factory вызывается при первом использовании)"""
+    _ENGINES[name] = factory
+
+def get_engine(engine: Union[str, OCREngine]) -> OCREngine:
+    if isinstance(engine, OCREngine):
+        return engine
+    factory = _ENGINES.get(engine)
+    if factory is None:
+        raise ValueError(f"Неизвестный OCR-движок: {engine} (доступны: {', '.join(_ENGINES)})")
+    return factory()
+
+def engine_name(engine: Union[None, str, OCREngine]) -> Optional[str]:
+    if engine is None:
+        return None
+    return engine if isinstance(engine, str) else engine.name
+
+def needs_ocr(text: str, min_chars: int = OCR_MIN_CHARS) -> bool:
+    """Почти нет текстового слоя — кандидат на OCR"""
+    return sum(1 for ch in text if not ch.isspace()) < min_chars
+
+def _recognize(engine: OCREngine, png: bytes, page_no: int) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    text = engine.recognize(png, page_no)
+    return text, time.perf_counter() - t0
+
+def run_ocr(
+        pages: Iterable[int],
+        render: Callable[[int], Optional[bytes]],
+        engine: Union[str, OCREngine],
+        workers: int = OCR_WORKERS,
+        budget: float = OCR_BUDGET_SEC,
+) -> Tuple[Dict[int, str], Dict[str, Any]]:
+    """
+    Распознаёт страницы pages (номера с 1).
+    render(page_no) -> PNG страницы или None (нечего распознавать, например нет изображений);
+    вызывается в текущем потоке, поэтому документ PyMuPDF не делится между потоками.
+    В работе не больше 2 * workers изображений; страницы, не распознанные до истечения
+    budget секунд, пропускаются (их текстовый слой остаётся как есть).
+
+    Возвращает (текст по номеру страницы, отчёт): ocr_engine, ocr_pages / ocr_times
+    (распознанные страницы и секунды на каждую), ocr_skipped, ocr_errors, ocr_seconds.
+    """
+    engine = get_engine(engine)
+    t_start = time.perf_counter()
+    deadline = time.monotonic() + budget
+    texts: Dict[int, str] = {}
+    times: Dict[int, float] = {}
+    skipped: List[int] = []
+    errors: List[Dict[str, Any]] = []
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ocr")
+    pending = {}
+    it = iter(pages)
+
+    def submit_next() -> bool:
+        for page_no in it:
+            if time.monotonic() >= deadline:
+                skipped.append(page_no)
+                continue
+            png = render(page_no)
+            if png is None:
+                continue
+            pending[pool.submit(_recognize, engine, png, page_no)] = page_no
+            return True
+        return False
+
+    try:
+        for _ in range(2 * max(1, workers)):
+            if not submit_next():
+                break
+        while pending:
+            done, _ = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                # бюджет исчерпан: незавершённые и оставшиеся страницы — без OCR
+                skipped.extend(pending.values())
+                skipped.extend(it)
+                break
+            for fut in done:
+                page_no = pending.pop(fut)
+                try:
+                    texts[page_no], times[page_no] = fut.result()
+                except Exception as e:
+                    errors.append({"page": page_no, "error": str(e)})
+                submit_next()
+    finally:
+        # зависшие вызовы движка не ждём
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    ocr_pages = sorted(texts)
+    return texts, {
+        "ocr_engine": engine.name,
+        "ocr_pages": ocr_pages,
+        "ocr_times": [round(times[p], 4) for p in ocr_pages],
+        "ocr_skipped": sorted(skipped),
+        "ocr_errors": errors,
+        "ocr_seconds": round(time.perf_counter() - t_start, 4),
+    }
@@ -1,6 +1,11 @@
+import math
 import re
+from array import array
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Any
+from typing import Iterable, Iterator, List, Optional, Dict, Tuple, Union
+
+from pipeline.constraints import Constraint, constraints_from_facts, extract_constraints, scan_text
+from pipeline.profiling import timed
 
 # 1) Ловим заголовки вида "3.2.4.1 Требования ..." или "3.2.4.1."
 HEADING_NUM_RE = re.compile(r"(?m)^\s*(?P<num>\d+(?:\.\d+)+)\.?\s+(?P<text>.+?)\s*$")
@@ -19,82 +24,60 @@ BULLET_RE = re.compile(r"(?m)^\s*[-\u2022]\s+(?P<text>.+?)\s*$")
 
 SECTION_RE = re.compile(r"(?mi)^\s*(?:Раздел|раздел)\s+(?P<sec>\d+)\.\s*(?P<title>.+?)\s*$")
 
-# Числа + единицы (расширили)
-NUM_UNIT_RE = re.compile(
-    r"(?i)(\d+(?:[.,]\d+)?)\s*(лм|в|вт|кг|г|мм|см|м|а|ма|ач|мбит/с|бит/с|гб|%|℃|°c|град/сек|мгц|дбмвт|ip\d{2})"
-)
-
-# Ограничения "не менее/не более/от...до..."
-MIN_RE = re.compile(r"(?i)\b(?:не\s+менее|не\s+ниже|минимум)\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
-MAX_RE = re.compile(r"(?i)\b(?:не\s+более|не\s+выше|максимум)\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
-RANGE_RE = re.compile(r"(?i)\bот\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?\s+до\s+(\d+(?:[.,]\d+)?)\s*([^\s,;:.]+)?")
-
-def _norm_unit(u: Optional[str]) -> str:
-    if not u:
-        return ""
-    u = u.strip().lower().replace("°c", "℃")
-    return u
-
-def _to_float(x: str) -> float:
-    return float(x.replace(",", "."))
-
-def extract_constraints(text: str) -> List[Dict[str, Any]]:
-    """
-    Возвращает список ограничений: >=, <=, range.
-    """
-    out: List[Dict[str, Any]] = []
-
-    for m in RANGE_RE.finditer(text):
-        a, u1, b, u2 = m.group(1), m.group(2), m.group(3), m.group(4)
-        unit = _norm_unit(u1 or u2)
-        out.append({"op": "range", "min": _to_float(a), "max": _to_float(b), "unit": unit})
-
-    for m in MIN_RE.finditer(text):
-        v, u = m.group(1), m.group(2)
-        out.append({"op": ">=", "value": _to_float(v), "unit": _norm_unit(u)})
-
-    for m in MAX_RE.finditer(text):
-        v, u = m.group(1), m.group(2)
-        out.append({"op": "<=", "value": _to_float(v), "unit": _norm_unit(u)})
-
-    # Если не нашли явных "не менее/не более", но есть числа+единицы — сохраним как "raw"
-    # (это помогает в скоринге, даже если проверить строго нельзя)
-    if not out:
-        nums_units = [(a.replace(",", "."), _norm_unit(b)) for a, b in NUM_UNIT_RE.findall(text)]
-        for a, b in nums_units:
-            out.append({"op": "raw", "value": _to_float(a), "unit": b})
-
-    return out
-
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Requirement:
     req_id: str
     num: str                  # для ссылок типа "п. 2.2.2 ТЗ"
     section: str
     text: str
-    nums_units: list[tuple[str, str]]
-    constraints: List[Dict[str, Any]]
+    nums_units: Tuple[Tuple[str, str], ...]
+    constraints: Tuple[Constraint, ...]
     kind: str                 # numeric / qualitative / composition / other
 
-def _classify_requirement(text: str, constraints: List[Dict[str, Any]]) -> str:
+KINDS = ("numeric", "qualitative", "composition", "other")
+
+def _classify_requirement(text: str, constraints: Iterable[Constraint]) -> str:
     t = text.lower()
     if "в состав" in t and ("долж" in t or "вход" in t):
         return "composition"
-    if any(c["op"] in (">=", "<=", "range") for c in constraints):
+    if any(c.op in (">=", "<=", "range") for c in constraints):
         return "numeric"
     if "долж" in t or "обеспеч" in t:
         return "qualitative"
     return "other"
 
-def parse_ttz_requirements(ttz_text: str) -> List[Requirement]:
+def _make_requirement(num: str, section: str, text: str) -> Requirement:
+    facts = scan_text(text)
+    constraints = tuple(constraints_from_facts(facts))
+    return Requirement(
+        req_id=f"TTZ-{num}",
+        num=num,
+        section=section or "UNKNOWN",
+        text=text,
+        nums_units=tuple(facts.nums_units),
+        constraints=constraints,
+        kind=_classify_requirement(text, constraints),
+    )
+
+def _iter_lines(chunks: Iterable[str]) -> Iterator[str]:
+    # граница элемента — граница строки (страницы PDF склеиваются через "\n")
+    for chunk in chunks:
+        yield from chunk.splitlines()
+
+def iter_ttz_requirements(chunks: Union[str, Iterable[str]]) -> Iterator[Requirement]:
+    """
+    Потоковый разбор ТТЗ: принимает строки или страницы (любое итерируемое, например
+    текст страниц из iter_pdf_pages) и отдаёт требования по мере готовности.
+    Состояние разбора — только текущий раздел, подпункт и счётчик буллетов.
+    """
+    if isinstance(chunks, str):
+        chunks = [chunks]
+
     current_section = ""
     current_heading_num: Optional[str] = None
     bullet_idx = 0
 
-    requirements: List[Requirement] = []
-    lines = ttz_text.splitlines()
-
-    for raw in lines:
+    for raw in _iter_lines(chunks):
         s = raw.strip()
         if not s:
             continue
@@ -118,20 +101,7 @@ def parse_ttz_requirements(ttz_text: str) -> List[Requirement]:
         if m:
             num = m.group("num")
             text = m.group("text").strip()
-            nums_units = [(a.replace(",", "."), _norm_unit(b)) for a, b in NUM_UNIT_RE.findall(text)]
-            constraints = extract_constraints(text)
-            kind = _classify_requirement(text, constraints)
-            requirements.append(
-                Requirement(
-                    req_id=f"TTZ-{num}",
-                    num=num,
-                    section=current_section or "UNKNOWN",
-                    text=text,
-                    nums_units=nums_units,
-                    constraints=constraints,
-                    kind=kind,
-                )
-            )
+            yield _make_requirement(num, current_section, text)
             continue
 
         # Буллеты под текущим подпунктом: "- ..."
@@ -141,19 +111,148 @@ def parse_ttz_requirements(ttz_text: str) -> List[Requirement]:
             text = mb.group("text").strip()
             # Присваиваем псевдо-номер, чтобы сохранялась связь с подпунктом
             num = f"{current_heading_num}-b{bullet_idx}"
-            nums_units = [(a.replace(",", "."), _norm_unit(b)) for a, b in NUM_UNIT_RE.findall(text)]
-            constraints = extract_constraints(text)
-            kind = _classify_requirement(text, constraints)
-            requirements.append(
-                Requirement(
-                    req_id=f"TTZ-{num}",
-                    num=num,
-                    section=current_section or "UNKNOWN",
-                    text=text,
-                    nums_units=nums_units,
-                    constraints=constraints,
-                    kind=kind,
-                )
-            )
-
-    return requirements
+            yield _make_requirement(num, current_section, text)
+
+@timed("parse_ttz_requirements", items=len)
+def parse_ttz_requirements(ttz_text: str) -> List[Requirement]:
+    return list(iter_ttz_requirements(ttz_text))
+
+# Коды операций в RequirementTable.c_ops (строгие — первые три, как в eval_constraints_batch)
+CONSTRAINT_OPS = (">=", "<=", "range", "raw")
+_OP_INDEX = {op: i for i, op in enumerate(CONSTRAINT_OPS)}
+
+def _opt(x: Optional[float]) -> float:
+    return math.nan if x is None else x
+
+def _from_opt(x: float) -> Optional[float]:
+    return None if math.isnan(x) else x
+
+class RequirementTable:
+    """
+    Колоночное хранение требований для больших (сводных) прогонов: тексты и номера —
+    списки строк, раздел, вид и единицы — коды в array, ограничения и числа с единицами —
+    плоские массивы со смещениями (ограничения требования i — c_offsets[i]:c_offsets[i + 1]).
+    Отсутствующие value/min/max хранятся как NaN.
+
+    Итерация и индексация отдают Requirement, поэтому таблицу можно передать везде,
+    где ждут список требований; eval_constraints_batch читает ограничения прямо из массивов.
+    """
+
+    def __init__(self, requirements: Iterable[Requirement] = ()):
+        self.req_ids: List[str] = []
+        self.nums: List[str] = []
+        self.texts: List[str] = []
+        self.section_codes = array("i")
+        self.kind_codes = array("b")
+        # справочники кодов (общие у таблицы и её срезов, только пополняются)
+        self.sections: List[str] = []
+        self.units: List[str] = []
+        self._section_index: Dict[str, int] = {}
+        self._unit_index: Dict[str, int] = {}
+
+        self.nu_offsets = array("q", [0])
+        self.nu_nums: List[str] = []
+        self.nu_units = array("i")
+
+        self.c_offsets = array("q", [0])
+        self.c_ops = array("b")
+        self.c_values = array("d")
+        self.c_mins = array("d")
+        self.c_maxs = array("d")
+        self.c_units = array("i")
+
+        self.extend(requirements)
+
+    def _code(self, index: Dict[str, int], values: List[str], s: str) -> int:
+        code = index.get(s)
+        if code is None:
+            code = index[s] = len(values)
+            values.append(s)
+        return code
+
+    def append(self, req: Requirement):
+        self.req_ids.append(req.req_id)
+        self.nums.append(req.num)
+        self.texts.append(req.text)
+        self.section_codes.append(self._code(self._section_index, self.sections, req.section))
+        self.kind_codes.append(KINDS.index(req.kind))
+
+        for n, u in req.nums_units:
+            self.nu_nums.append(n)
+            self.nu_units.append(self._code(self._unit_index, self.units, u))
+        self.nu_offsets.append(len(self.nu_nums))
+
+        for c in req.constraints:
+            self.c_ops.append(_OP_INDEX[c.op])
+            self.c_values.append(_opt(c.value))
+            self.c_mins.append(_opt(c.min))
+            self.c_maxs.append(_opt(c.max))
+            self.c_units.append(self._code(self._unit_index, self.units, c.unit))
+        self.c_offsets.append(len(self.c_ops))
+
+    def extend(self, requirements: Iterable[Requirement]):
+        for req in requirements:
+            self.append(req)
+
+    def __len__(self) -> int:
+        return len(self.req_ids)
+
+    def constraint(self, j: int) -> Constraint:
+        """Ограничение по его номеру в плоских массивах"""
+        return Constraint(
+            CONSTRAINT_OPS[self.c_ops[j]],
+            _from_opt(self.c_values[j]),
+            _from_opt(self.c_mins[j]),
+            _from_opt(self.c_maxs[j]),
+            self.units[self.c_units[j]],
+        )
+
+    def __getitem__(self, i: int) -> Requirement:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        units = self.units
+        return Requirement(
+            req_id=self.req_ids[i],
+            num=self.nums[i],
+            section=self.sections[self.section_codes[i]],
+            text=self.texts[i],
+            nums_units=tuple(
+                (self.nu_nums[k], units[self.nu_units[k]])
+                for k in range(self.nu_offsets[i], self.nu_offsets[i + 1])
+            ),
+            constraints=tuple(self.constraint(j) for j in range(self.c_offsets[i], self.c_offsets[i + 1])),
+            kind=KINDS[self.kind_codes[i]],
+        )
+
+    def __iter__(self) -> Iterator[Requirement]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def slice(self, start: int, stop: int) -> "RequirementTable":
+        """Подтаблица [start, stop) — с теми же справочниками кодов, без пересборки требований"""
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        sub = RequirementTable()
+        sub.sections, sub._section_index = self.sections, self._section_index
+        sub.units, sub._unit_index = self.units, self._unit_index
+        sub.req_ids = self.req_ids[start:stop]
+        sub.nums = self.nums[start:stop]
+        sub.texts = self.texts[start:stop]
+        sub.section_codes = self.section_codes[start:stop]
+        sub.kind_codes = self.kind_codes[start:stop]
+
+        a, b = self.nu_offsets[start], self.nu_offsets[stop]
+        sub.nu_offsets = array("q", (o - a for o in self.nu_offsets[start:stop + 1]))
+        sub.nu_nums = self.nu_nums[a:b]
+        sub.nu_units = self.nu_units[a:b]
+
+        a, b = self.c_offsets[start], self.c_offsets[stop]
+        sub.c_offsets = array("q", (o - a for o in self.c_offsets[start:stop + 1]))
+        sub.c_ops = self.c_ops[a:b]
+        sub.c_values = self.c_values[a:b]
+        sub.c_mins = self.c_mins[a:b]
+        sub.c_maxs = self.c_maxs[a:b]
+        sub.c_units = self.c_units[a:b]
+        return sub
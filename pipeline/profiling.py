@@ -0,0 +1,116 @@
+"""
+Лёгкий профилировщик стадий пайплайна.
+
+    with profiling() as prof:
+        ...                      # функции pipeline/* сами пишут в активный профиль
+    prof.summary()
+
+Вне with profiling() все stage/timed/observe — почти бесплатные no-op.
+"""
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+class StageRecord:
+    __slots__ = ("calls", "items", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.seconds = 0.0
+
+class _StageHandle:
+    """То, что отдаёт with stage(...): позволяет дописать число обработанных элементов"""
+    __slots__ = ("items",)
+
+    def __init__(self, items: int):
+        self.items = items
+
+class Profiler:
+    def __init__(self):
+        self.stages: Dict[str, StageRecord] = {}
+        # распределения времени по элементам: имя -> [(секунды, метка)]
+        self.samples: Dict[str, List[Tuple[float, str]]] = {}
+
+    def add(self, name: str, seconds: float, items: int = 0, calls: int = 1):
+        rec = self.stages.get(name)
+        if rec is None:
+            rec = self.stages[name] = StageRecord()
+        rec.calls += calls
+        rec.items += items
+        rec.seconds += seconds
+
+    def observe(self, name: str, seconds: float, label: str):
+        self.samples.setdefault(name, []).append((seconds, label))
+
+    def summary(self, slowest: int = 10) -> Dict[str, Any]:
+        stages = [
+            {"stage": name, "calls": r.calls, "items": r.items, "seconds": round(r.seconds, 6)}
+            for name, r in self.stages.items()
+        ]
+        dists = {}
+        for name, samples in self.samples.items():
+            times = sorted(s for s, _ in samples)
+            n = len(times)
+            dists[name] = {
+                "count": n,
+                "seconds": sum(times),
+                "p50": times[n // 2],
+                "p95": times[min(n - 1, int(n * 0.95))],
+                "max": times[-1],
+                "slowest": [
+                    {"label": label, "seconds": round(s, 6)}
+                    for s, label in sorted(samples, key=lambda x: x[0], reverse=True)[:slowest]
+                ],
+            }
+        return {"stages": stages, "distributions": dists}
+
+_current: ContextVar[Optional[Profiler]] = ContextVar("pipeline_profiler", default=None)
+
+def current_profiler() -> Optional[Profiler]:
+    return _current.get()
+
+@contextmanager
+def profiling(profiler: Optional[Profiler] = None) -> Iterator[Profiler]:
+    """Делает профиль активным на время блока"""
+    prof = profiler or Profiler()
+    token = _current.set(prof)
+    try:
+        yield prof
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def stage(name: str, items: int = 0) -> Iterator[_StageHandle]:
+    prof = _current.get()
+    handle = _StageHandle(items)
+    if prof is None:
+        yield handle
+        return
+    t0 = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        prof.add(name, time.perf_counter() - t0, handle.items)
+
+def observe(name: str, seconds: float, label: str):
+    prof = _current.get()
+    if prof is not None:
+        prof.observe(name, seconds, label)
+
+def timed(name: str, items: Optional[Callable[[Any], int]] = None):
+    """Декоратор: время вызова идёт в стадию name, items(result) — число элементов"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            prof = _current.get()
+            if prof is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            result = fn(*args, **kwargs)
+            prof.add(name, time.perf_counter() - t0, items(result) if items else 0)
+            return result
+        return wrapper
+    return deco